@@ -0,0 +1,189 @@
+import time
+import datetime
+import logging
+import threading
+from contextlib import contextmanager
+import metrics
+from utils import parsebytes
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+# yt-dlp protocols downloaded as fragments, by concurrent_fragment_downloads threads
+FRAGMENTED = ('m3u8', 'http_dash_segments', 'ism', 'f4m')
+
+def parserate(rate):
+    """Converts a rate from config.yml to bytes per second
+    - ``rate``: bytes per second with an optional K, M or G suffix (e.g. 500K, 2.5M)
+
+    returns:
+        ``int``: bytes per second, None when unlimited (empty or 0)
+    """
+    try:
+        return parsebytes(rate)
+    except ValueError:
+        raise ValueError('Invalid rate {}'.format(rate))
+
+
+def parsetime(value):
+    """Converts HH:MM from config.yml to a ``datetime.time``"""
+    return datetime.datetime.strptime(str(value).strip(), '%H:%M').time()
+
+
+def parseschedule(schedule):
+    """Converts bandwidth_schedule from config.yml to (start, end, rate) windows
+    - ``schedule``: list of dicts with ``start``, ``end`` and ``limit``, see ``BandwidthManager``
+    """
+    return [
+        (parsetime(window['start']), parsetime(window['end']), parserate(window.get('limit')))
+        for window in schedule or []
+    ]
+
+
+class BandwidthManager(object):
+    """Shares one total download rate between every running download
+
+    The total is ``limit`` unless a schedule window covering the local time
+    sets its own. Each download gets its yt-dlp ``ratelimit`` from the total:
+    downloads that use less than an equal share keep what they use plus some
+    headroom, the rest is split between the downloads that can use more.
+    Shares are rebalanced when downloads start or finish, when a window opens
+    or closes, and every few seconds from the progress hooks. yt-dlp's http
+    downloader reads ``ratelimit`` from its params while downloading, so
+    running plain http downloads follow the new share without restarting.
+    HLS and DASH downloads copy the params when they start and keep the
+    share they started with until they finish.
+    """
+
+    # seconds between rebalances from progress hooks
+    interval = 5
+    # share above its measured speed a download is allowed to grow into
+    headroom = 1.25
+
+    def __init__(self, limit=None, schedule=None):
+        """Set the policy
+        - ``limit``: total rate outside schedule windows, see ``parserate``
+        - ``schedule``: list of dicts with ``start`` and ``end`` (HH:MM, local time)
+          and the ``limit`` applying in between, windows may wrap midnight
+        """
+        self.lock = threading.Lock()
+        self.downloads = {}
+        self.speeds = {}
+        self.fragmented = set()
+        self.applied = None
+        self.balanced = 0
+        self.configure(limit, schedule)
+
+    def configure(self, limit=None, schedule=None):
+        """Replace the policy, running downloads are rebalanced to it"""
+        windows = parseschedule(schedule)
+        with self.lock:
+            self.limit = parserate(limit)
+            self.windows = windows
+            self.rebalance()
+
+    def current(self, now=None):
+        """Total rate allowed at the given local time, None when unlimited"""
+        now = (now or datetime.datetime.now()).time()
+        for start, end, limit in self.windows:
+            if start <= now < end or (end <= start and (now >= start or now < end)):
+                return limit
+        return self.limit
+
+    def rebalance(self):
+        """Hand out the current total between running downloads
+        Must be called with ``self.lock`` held.
+        """
+        total = self.current()
+        if total != self.applied:
+            logger.info('Download rate limit {}'.format(
+                'removed' if total is None else 'set to {:.0f}KiB/s'.format(total / 1024)
+            ))
+            self.applied = total
+        self.balanced = time.monotonic()
+        metrics.setgauge('bandwidth_limit_bytes', total or 0)
+        if not self.downloads:
+            return
+        if total is None:
+            for params in self.downloads.values():
+                params.pop('ratelimit', None)
+            return
+        remaining = total
+        satisfied = []
+        # downloads that have not reported a speed yet can use any share, they go last
+        hungry = sorted(self.downloads.items(), key=lambda item: self.speeds.get(item[0]) or float('inf'))
+        while hungry:
+            share = remaining / len(hungry)
+            token, params = hungry[0]
+            speed = self.speeds.get(token)
+            demand = speed * self.headroom if speed else None
+            if demand is None or demand >= share:
+                break
+            satisfied.append((token, params, demand))
+            hungry.pop(0)
+            remaining -= demand
+        for token, params, demand in satisfied:
+            # with nobody able to use more, the spare rate is split evenly
+            self.setshare(token, params, demand if hungry else demand + remaining / len(satisfied))
+        for token, params in hungry:
+            self.setshare(token, params, remaining / len(hungry))
+
+    def setshare(self, token, params, share):
+        """Set a download's ratelimit to its share
+        yt-dlp applies ratelimit to every fragment download thread on its own,
+        so the share of a fragmented download is split between its concurrent
+        fragments. Plain http downloads are a single stream and get it whole.
+        """
+        if token in self.fragmented:
+            share /= max(1, params.get('concurrent_fragment_downloads') or 1)
+        params['ratelimit'] = max(int(share), 1)
+
+    @contextmanager
+    def download(self, ydl):
+        """Keep a download within its share while the block runs
+        - ``ydl``: YoutubeDL of the download, its ``params['ratelimit']`` is updated in place.
+          Its ``dl`` is wrapped to note the protocol of each stream before it starts.
+
+        yields:
+            progress hook to add to the YoutubeDL, it tracks the download's speed
+        """
+        token = object()
+        params = ydl.params
+        dl = ydl.dl
+
+        def protocol_dl(name, info, *args, **kwargs):
+            if not kwargs.get('subtitle') and not kwargs.get('test'):
+                # set before the downloader starts, fragment downloaders copy the params
+                protocols = (info.get('protocol') or '').split('+')
+                with self.lock:
+                    if any(protocol.startswith(FRAGMENTED) for protocol in protocols):
+                        self.fragmented.add(token)
+                    else:
+                        self.fragmented.discard(token)
+                    self.rebalance()
+            return dl(name, info, *args, **kwargs)
+
+        ydl.dl = protocol_dl
+
+        def hook(d):
+            if d['status'] != 'downloading':
+                return
+            with self.lock:
+                if token not in self.downloads:
+                    return
+                if d.get('speed'):
+                    self.speeds[token] = d['speed']
+                if time.monotonic() - self.balanced >= self.interval or self.current() != self.applied:
+                    self.rebalance()
+
+        with self.lock:
+            self.downloads[token] = params
+            self.rebalance()
+        try:
+            yield hook
+        finally:
+            with self.lock:
+                del self.downloads[token]
+                self.speeds.pop(token, None)
+                self.fragmented.discard(token)
+                self.rebalance()
@@ -0,0 +1,311 @@
+import os
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+import metrics
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+# youtube channel pages and channel upload playlists, which list the newest upload first
+NEWEST_FIRST = re.compile(
+    r'^https?://(?:www\.|m\.)?youtube\.com/(?:(?:channel|c|user)/[^/?#]+|@[^/?#]+)(?:/(?:videos|streams|shorts|featured))?/?(?:[?#]|$)'
+    r'|[?&]list=UU[\w-]+'
+)
+
+
+def newestfirst(url):
+    """Whether the url is known to list its newest upload first
+    Other playlists may be sorted oldest first with new uploads appended at
+    the end, so an incremental walk that stops at the first known video
+    would not see them.
+    """
+    return NEWEST_FIRST.search(url) is not None
+
+
+class JsonCache(object):
+    """A dict persisted to a json file in the config folder"""
+
+    name = 'Cache'
+
+    def __init__(self, path):
+        """Load the cache from disk
+        - ``path``: json file to persist the cache to
+        """
+        self.path = path
+        self.data = {}
+        self.lock = threading.RLock()
+        self.load()
+
+    def load(self):
+        """Read the cache file, starting empty if missing or unreadable"""
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as cachefile:
+                self.data = json.load(cachefile)
+            logger.debug('{} loaded with {} entries'.format(self.name, len(self.data)))
+        except Exception as e:
+            logger.warning('{} could not be read, starting empty - {}'.format(self.name, e))
+            self.data = {}
+
+    def save(self):
+        """Write the cache file, replacing the old one atomically"""
+        tmp = self.path + '.tmp'
+        try:
+            with self.lock, open(tmp, 'w') as cachefile:
+                json.dump(self.data, cachefile)
+            os.replace(tmp, self.path)
+        except Exception as e:
+            logger.warning('{} could not be saved - {}'.format(self.name, e))
+
+
+class PlaylistCache(JsonCache):
+    """Persistent index of the videos found on each series url
+
+    Entries are kept in the order the site lists them, newest uploads are
+    prepended on incremental refreshes and the whole list is replaced when a
+    full re-walk is done.
+    """
+
+    name = 'Playlist cache'
+
+    def __init__(self, path, ttl=1440):
+        """Load the cache from disk
+        - ``path``: json file to persist the cache to
+        - ``ttl``: minutes before a url is fully re-walked, 0 always re-walks
+        """
+        self.ttl = int(ttl) * 60
+        super().__init__(path)
+
+    def expired(self, url):
+        """Whether the url needs a full re-walk of its playlist"""
+        cached = self.data.get(url)
+        if cached is None:
+            return True
+        return time.time() - cached['refreshed'] >= self.ttl
+
+    def known(self, url):
+        """Set of video ids already cached for the url"""
+        cached = self.data.get(url)
+        if cached is None:
+            return set()
+        return {entry['id'] for entry in cached['entries'] if entry['id'] is not None}
+
+    def changed(self, url):
+        """Time the videos of the url last changed, 0 if never extracted"""
+        cached = self.data.get(url)
+        if cached is None:
+            return 0
+        return cached.get('changed', cached['refreshed'])
+
+    def checked(self, url):
+        """Time the url was last extracted, 0 if never"""
+        cached = self.data.get(url)
+        if cached is None:
+            return 0
+        return cached.get('checked', cached['refreshed'])
+
+    def index(self, url):
+        """The cached playlist index for the url, None if never extracted"""
+        cached = self.data.get(url)
+        if cached is None:
+            return None
+        return cached['entries']
+
+    def update(self, url, entries, full=False):
+        """Store freshly extracted entries for the url
+        - ``url``: series url the entries were extracted from
+        - ``entries``: entries in site order, newest first for channels
+        - ``full``: entries are the whole playlist rather than the newest uploads
+        returns:
+            ``list``: the cached playlist index for the url
+        """
+        with self.lock:
+            cached = self.data.get(url)
+            if full or cached is None:
+                changed = time.time()
+                if cached is not None and [entry['id'] for entry in entries] == [entry['id'] for entry in cached['entries']]:
+                    changed = self.changed(url)
+                self.data[url] = {
+                    'refreshed': time.time(),
+                    'changed': changed,
+                    'entries': entries,
+                }
+            elif entries:
+                ids = {entry['id'] for entry in entries}
+                cached['entries'] = entries + [entry for entry in cached['entries'] if entry['id'] not in ids]
+                cached['changed'] = time.time()
+                logger.debug('Playlist cache added {} new videos for {}'.format(len(entries), url))
+            self.data[url]['checked'] = time.time()
+            return self.data[url]['entries']
+
+
+class MissCache(JsonCache):
+    """Persistent record of episodes that were not found on the site
+
+    A missed episode is not searched for again until its backoff, doubling
+    with every miss, has passed. Records are dropped when the episode title
+    (as normalized for matching) changes or the playlist gets new videos.
+    """
+
+    name = 'Miss cache'
+
+    def __init__(self, path, backoff=60, maximum=10080):
+        """Load the cache from disk
+        - ``path``: json file to persist the cache to
+        - ``backoff``: minutes before a first miss is checked again, 0 disables the cache
+        - ``maximum``: longest backoff in minutes
+        """
+        self.backoff = int(backoff) * 60
+        self.maximum = int(maximum) * 60
+        super().__init__(path)
+
+    def key(self, series_id, episode_id):
+        return '{}:{}'.format(series_id, episode_id)
+
+    def skip(self, series_id, episode_id, title, playlist_changed):
+        """Whether the episode is still backing off from earlier misses
+        - ``series_id``: Sonarr series id
+        - ``episode_id``: Sonarr episode id
+        - ``title``: normalized title the episode is matched with
+        - ``playlist_changed``: ``PlaylistCache.changed`` of the series url
+        """
+        if self.backoff <= 0:
+            return False
+        with self.lock:
+            record = self.data.get(self.key(series_id, episode_id))
+            if record is None:
+                return False
+            if record.get('title') != title or record['playlist'] != playlist_changed:
+                del self.data[self.key(series_id, episode_id)]
+                return False
+            return time.time() < record['retry']
+
+    def miss(self, series_id, episode_id, title, playlist_changed):
+        """Record the episode was not found and back off from it"""
+        if self.backoff <= 0:
+            return
+        with self.lock:
+            record = self.data.get(self.key(series_id, episode_id), {'misses': 0})
+            misses = record['misses'] + 1
+            self.data[self.key(series_id, episode_id)] = {
+                'title': title,
+                'playlist': playlist_changed,
+                'misses': misses,
+                'retry': time.time() + min(self.backoff * 2 ** (misses - 1), self.maximum),
+            }
+
+    def forget(self, series_id, episode_id):
+        """Drop the record of an episode that was found"""
+        with self.lock:
+            self.data.pop(self.key(series_id, episode_id), None)
+
+
+class ResponseCache(object):
+    """Sonarr responses kept between scans, the least recently used dropped first
+
+    Entries are json serializable values keyed by endpoint and id, served
+    while younger than their endpoint's ttl. Entries stored with a revision
+    are only served while the caller's revision still matches, so a series
+    Sonarr changed is fetched again straight away. With a spill file,
+    entries pushed out of memory (and all of them on ``save``) are kept in
+    sqlite and survive restarts.
+    """
+
+    def __init__(self, ttls, size=1000, spill=None):
+        """Set up the cache
+        - ``ttls``: dict of endpoint to minutes its responses are kept, 0 disables caching it
+        - ``size``: entries kept in memory
+        - ``spill``: sqlite file for entries that do not fit in memory, None keeps memory only
+        """
+        self.ttls = {endpoint: int(minutes) * 60 for endpoint, minutes in ttls.items()}
+        self.size = max(1, int(size))
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.spill = None
+        if spill:
+            self.spill = sqlite3.connect(spill, check_same_thread=False)
+            with self.spill:
+                self.spill.execute(
+                    'CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, revision TEXT, stored REAL NOT NULL, body TEXT NOT NULL)'
+                )
+
+    def key(self, endpoint, item):
+        return '{}:{}'.format(endpoint, item)
+
+    def enabled(self, endpoint):
+        """Whether responses of the endpoint are cached at all"""
+        return self.ttls.get(endpoint, 0) > 0
+
+    def get(self, endpoint, item, revision=None):
+        """Cached value, None if missing, expired or of another revision
+        - ``endpoint``: endpoint the value came from, picks the ttl
+        - ``item``: what the value is for, unique across Sonarr instances (e.g. the request url)
+        - ``revision``: current revision of the item, None if unknown
+        """
+        ttl = self.ttls.get(endpoint, 0)
+        if ttl <= 0:
+            return None
+        key = self.key(endpoint, item)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            elif self.spill is not None:
+                row = self.spill.execute('SELECT revision, stored, body FROM responses WHERE key = ?', (key,)).fetchone()
+                if row is not None:
+                    entry = (row[0], row[1], json.loads(row[2]))
+                    self.entries[key] = entry
+                    self.evict()
+        if entry is None or time.time() - entry[1] >= ttl or entry[0] != revision:
+            metrics.inc('cache_requests_total', cache='sonarr', result='miss')
+            return None
+        metrics.inc('cache_requests_total', cache='sonarr', result='hit')
+        return entry[2]
+
+    def put(self, endpoint, item, value, revision=None):
+        """Store a fresh value, see ``get``"""
+        if self.ttls.get(endpoint, 0) <= 0:
+            return
+        with self.lock:
+            self.entries[self.key(endpoint, item)] = (revision, time.time(), value)
+            self.entries.move_to_end(self.key(endpoint, item))
+            self.evict()
+
+    def invalidate(self, endpoint, item):
+        """Forget the value of an item, e.g. after a rescan or a webhook for it"""
+        key = self.key(endpoint, item)
+        with self.lock:
+            self.entries.pop(key, None)
+            if self.spill is not None:
+                with self.spill:
+                    self.spill.execute('DELETE FROM responses WHERE key = ?', (key,))
+
+    def evict(self):
+        """Drop the least recently used entries over ``size``, to the spill file if any
+        Must be called with ``self.lock`` held.
+        """
+        evicted = []
+        while len(self.entries) > self.size:
+            evicted.append(self.entries.popitem(last=False))
+        if evicted and self.spill is not None:
+            self.write(evicted)
+
+    def write(self, entries):
+        with self.spill:
+            self.spill.executemany(
+                'INSERT OR REPLACE INTO responses (key, revision, stored, body) VALUES (?, ?, ?, ?)',
+                [(key, revision, stored, json.dumps(value)) for key, (revision, stored, value) in entries]
+            )
+
+    def save(self):
+        """Write the entries in memory to the spill file, if any"""
+        if self.spill is None:
+            return
+        with self.lock:
+            self.write(list(self.entries.items()))
@@ -0,0 +1,260 @@
+import heapq
+import logging
+import itertools
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor, Future, wait
+import metrics
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+
+def sitekey(url):
+    """Host used to group downloads for the per site limit
+    - ``url``: url of the video to download
+
+    returns:
+        ``string``: host name without leading www.
+    """
+    host = urllib.parse.urlparse(url).netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    return host
+
+
+# download_order rules, each ranks a queued download, lower starts first
+RULES = {
+    # downloads queued from a webhook scan
+    'webhook': lambda scheduler, job: 0 if job.urgent else 1,
+    # higher series priority from config.yml
+    'priority': lambda scheduler, job: -job.priority,
+    # series that had fewer downloads started since it last ran dry, so series take turns
+    'fair': lambda scheduler, job: scheduler.served.get(job.series, 0),
+    'newest': lambda scheduler, job: float('inf') if job.aired is None else -job.aired,
+    'oldest': lambda scheduler, job: float('inf') if job.aired is None else job.aired,
+}
+DEFAULT_ORDER = ['webhook', 'priority', 'fair', 'newest']
+
+
+def parseorder(order):
+    """Converts download_order from config.yml to a list of rule names
+    - ``order``: list or comma separated string of ``RULES`` names, the default order if empty
+    """
+    if not order:
+        return list(DEFAULT_ORDER)
+    if isinstance(order, str):
+        order = order.split(',')
+    order = [str(rule).strip().lower() for rule in order]
+    for rule in order:
+        if rule not in RULES:
+            raise ValueError('Unknown download_order rule {}'.format(rule))
+    return order
+
+
+class QueuedDownload(object):
+    """A submitted download waiting for a slot"""
+
+    __slots__ = ['seq', 'future', 'func', 'args', 'site', 'series', 'priority', 'aired', 'urgent', 'prefetched']
+
+    def __init__(self, seq, future, func, args, site, series, priority, aired, urgent):
+        self.seq = seq
+        self.future = future
+        self.func = func
+        self.args = args
+        self.site = site
+        self.series = series
+        self.priority = priority
+        self.aired = aired
+        self.urgent = urgent
+        # Future of the prefetch run for the download, None until it nears a slot
+        self.prefetched = None
+
+
+class DownloadScheduler(object):
+    """Bounded worker pool for episode downloads
+
+    At most ``max_downloads`` downloads run at once overall and at most
+    ``max_per_site`` of those against the same host. Jobs waiting on a busy
+    host never hold a worker, so other sites keep downloading. A free slot
+    goes to the queued download ranked first by the ``order`` rules, ties
+    are started in submission order.
+
+    With a ``prefetch`` callable, whenever downloads start the
+    ``max_downloads`` best ranked of the queued ones are prepared for the
+    next free slots, e.g. their page extracted. Only downloads at the head
+    of the queue hold prepared state, and a download that starts while its
+    prefetch runs waits for it rather than repeating it.
+    """
+
+    def __init__(self, max_downloads=1, max_per_site=1, order=None, prefetch=None):
+        """Start the pool
+        - ``max_downloads``: downloads running at once
+        - ``max_per_site``: downloads running at once against one host
+        - ``order``: ``RULES`` names to rank queued downloads by, see ``parseorder``
+        - ``prefetch``: called with the arguments of a download before it starts, None to disable
+        """
+        self.max_downloads = max(1, int(max_downloads))
+        self.max_per_site = max(1, int(max_per_site))
+        self.order = parseorder(order)
+        self.rules = [RULES[rule] for rule in self.order]
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.max_downloads,
+            thread_name_prefix='download'
+        )
+        self.prefetch = prefetch
+        self.prefetcher = None
+        if prefetch is not None:
+            self.prefetcher = ThreadPoolExecutor(
+                max_workers=self.max_downloads,
+                thread_name_prefix='prefetch'
+            )
+        self.lock = threading.Lock()
+        self.counter = itertools.count()
+        self.queued = []
+        self.served = {}
+        self.running = {}
+        self.active = 0
+        self.pending = set()
+        # Future of each started download mapped to its host
+        self.started = {}
+        logger.debug('Download scheduler using {} workers, {} per site'.format(
+            self.max_downloads,
+            self.max_per_site
+        ))
+
+    def submit(self, url, func, *args, series=None, priority=0, aired=None, urgent=False):
+        """Queue a download
+        - ``url``: url being downloaded, used for the per site limit
+        - ``func``: callable doing the download
+        - ``args``: arguments passed to func
+        - ``series``: key of the series downloaded, for the fair rule
+        - ``priority``: priority of the series, for the priority rule
+        - ``aired``: air time of the episode in seconds since the epoch, for the newest and oldest rules
+        - ``urgent``: requested from a webhook, for the webhook rule
+        returns:
+            ``Future``
+        """
+        future = Future()
+        with self.lock:
+            if series not in self.served:
+                # a series joining the queue starts level with the others instead of ahead of them
+                self.served[series] = min(self.served.values(), default=0)
+            self.queued.append(QueuedDownload(
+                next(self.counter), future, func, args, sitekey(url), series, priority, aired, urgent
+            ))
+            self.pending.add(future)
+            self.dispatch()
+        return future
+
+    def rank(self, job):
+        return [rule(self, job) for rule in self.rules] + [job.seq]
+
+    def dispatch(self):
+        """Start the best ranked queued jobs while global and per site slots are free
+        Must be called with ``self.lock`` held.
+        """
+        started = False
+        while self.active < self.max_downloads:
+            ready = [job for job in self.queued if self.running.get(job.site, 0) < self.max_per_site]
+            if not ready:
+                break
+            job = min(ready, key=self.rank)
+            self.queued.remove(job)
+            self.active += 1
+            self.running[job.site] = self.running.get(job.site, 0) + 1
+            self.started[job.future] = job.site
+            self.served[job.series] += 1
+            if not any(queued.series == job.series for queued in self.queued):
+                del self.served[job.series]
+            self.pool.submit(self.run, job)
+            started = True
+        if started and self.prefetch is not None and self.queued:
+            # the best ranked of the rest take the next free slots
+            for job in heapq.nsmallest(self.max_downloads, self.queued, key=self.rank):
+                if job.prefetched is None:
+                    job.prefetched = self.prefetcher.submit(self.runprefetch, job)
+        metrics.setgauge('download_queue_depth', len(self.queued))
+        metrics.setgauge('downloads_active', self.active)
+
+    def runprefetch(self, job):
+        try:
+            self.prefetch(*job.args)
+        except Exception as e:
+            logger.debug('Prefetch failed - {}'.format(e))
+
+    def run(self, job):
+        future = job.future
+        if job.prefetched is not None:
+            wait([job.prefetched])
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(job.func(*job.args))
+            except Exception as e:
+                logger.error('Download worker failed - {}'.format(e))
+                future.set_exception(e)
+        with self.lock:
+            self.active -= 1
+            self.running[job.site] -= 1
+            self.pending.discard(future)
+            self.started.pop(future, None)
+            self.dispatch()
+
+    def adopt(self, other):
+        """Move the downloads still queued on another scheduler to this one
+        Downloads already running finish on ``other``, which then shuts down in
+        the background. Until they are done they take up their slots here and
+        ``wait`` covers them.
+        - ``other``: scheduler being replaced, no longer submitted to
+        """
+        with other.lock:
+            jobs = sorted(other.queued, key=lambda job: job.seq)
+            other.queued = []
+            other.served = {}
+            for job in jobs:
+                other.pending.discard(job.future)
+            running = dict(other.started)
+        with self.lock:
+            for job in jobs:
+                job.seq = next(self.counter)
+                if job.series not in self.served:
+                    self.served[job.series] = min(self.served.values(), default=0)
+                self.queued.append(job)
+                self.pending.add(job.future)
+            for future, site in running.items():
+                self.active += 1
+                self.running[site] = self.running.get(site, 0) + 1
+                self.started[future] = site
+                self.pending.add(future)
+            self.dispatch()
+        for future in running:
+            # outside the lock, the callback runs right away for a finished future
+            future.add_done_callback(self.release)
+        threading.Thread(target=other.shutdown, name='download-drain', daemon=True).start()
+        logger.debug('Download scheduler took over {} queued downloads, {} still running'.format(
+            len(jobs),
+            len(running)
+        ))
+
+    def release(self, future):
+        """Free the slot of a download adopted while it ran on the previous scheduler"""
+        with self.lock:
+            site = self.started.pop(future, None)
+            if site is None:
+                return
+            self.active -= 1
+            self.running[site] -= 1
+            self.pending.discard(future)
+            self.dispatch()
+
+    def wait(self):
+        """Block until every download queued so far has finished"""
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+        if self.prefetcher is not None:
+            self.prefetcher.shutdown()
@@ -0,0 +1,115 @@
+import json
+import time
+import sqlite3
+import logging
+import threading
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+ACTIVE = ['queued', 'downloading', 'postprocessing']
+
+SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS jobs (
+        id INTEGER PRIMARY KEY,
+        instance TEXT NOT NULL DEFAULT '',
+        series_id INTEGER NOT NULL,
+        series_title TEXT NOT NULL DEFAULT '',
+        episode_id INTEGER NOT NULL,
+        title TEXT NOT NULL,
+        url TEXT NOT NULL,
+        options TEXT NOT NULL,
+        aired TEXT,
+        priority INTEGER NOT NULL DEFAULT 0,
+        state TEXT NOT NULL,
+        error TEXT,
+        updated REAL NOT NULL,
+        UNIQUE (instance, series_id, episode_id)
+    )
+'''
+
+
+class JobStore(object):
+    """SQLite record of every found episode and how far its download got
+
+    Jobs hold everything needed to download again without searching: the
+    resolved url, the Youtube-dl options and output template. Jobs left
+    queued, downloading or postprocessing by a restart are resumed on
+    startup, yt-dlp continues any ``.part`` files they left behind.
+    """
+
+    def __init__(self, path):
+        """Open or create the job database
+        - ``path``: sqlite file to store jobs in
+        """
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+        with self.lock, self.db:
+            self.db.execute(SCHEMA)
+
+    def job(self, row):
+        job = dict(row)
+        job['options'] = json.loads(job['options'])
+        return job
+
+    def add(self, instance, series_id, series_title, episode_id, title, url, options, aired=None, priority=0):
+        """Queue a found episode
+        - ``instance``: name of the Sonarr instance the series is in
+        - ``series_id``: Sonarr series id
+        - ``series_title``: series title, for logging and metrics
+        - ``episode_id``: Sonarr episode id
+        - ``title``: episode title, for logging
+        - ``url``: resolved url of the video
+        - ``options``: Youtube-dl options, anything not json serializable is dropped
+        - ``aired``: airDateUtc of the episode, for ordering downloads
+        - ``priority``: priority of the series, for ordering downloads
+        returns:
+            ``dict``: the queued job, None if the episode already has an active job
+        """
+        options = {key: value for key, value in options.items() if key not in ['logger', 'progress_hooks', 'postprocessor_hooks']}
+        with self.lock, self.db:
+            row = self.db.execute(
+                'SELECT state FROM jobs WHERE instance = ? AND series_id = ? AND episode_id = ?',
+                (instance, series_id, episode_id)
+            ).fetchone()
+            if row is not None and row['state'] in ACTIVE:
+                return None
+            self.db.execute('''
+                INSERT INTO jobs (instance, series_id, series_title, episode_id, title, url, options, aired, priority, state, error, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', NULL, ?)
+                ON CONFLICT (instance, series_id, episode_id) DO UPDATE SET
+                    series_title = excluded.series_title, title = excluded.title, url = excluded.url,
+                    options = excluded.options, aired = excluded.aired, priority = excluded.priority,
+                    state = 'queued', error = NULL, updated = excluded.updated
+            ''', (instance, series_id, series_title, episode_id, title, url, json.dumps(options), aired, int(priority), time.time()))
+            row = self.db.execute(
+                'SELECT * FROM jobs WHERE instance = ? AND series_id = ? AND episode_id = ?',
+                (instance, series_id, episode_id)
+            ).fetchone()
+        return self.job(row)
+
+    def setstate(self, job_id, state, error=None):
+        """Move a job to queued, downloading, postprocessing, done or failed"""
+        with self.lock, self.db:
+            self.db.execute(
+                'UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ?',
+                (state, error, time.time(), job_id)
+            )
+
+    def unfinished(self):
+        """Jobs a previous run left queued, downloading or postprocessing"""
+        with self.lock:
+            rows = self.db.execute(
+                'SELECT * FROM jobs WHERE state IN ({}) ORDER BY id'.format(', '.join('?' * len(ACTIVE))),
+                ACTIVE
+            ).fetchall()
+        return [self.job(row) for row in rows]
+
+    def prune(self, days=30):
+        """Forget finished jobs older than the given days"""
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM jobs WHERE state IN ('done', 'failed') AND updated < ?",
+                (time.time() - days * 86400,)
+            )
@@ -0,0 +1,70 @@
+import re
+
+
+QUOTES = str.maketrans({'’': "'", '‘': "'", '“': '"', '”': '"'})
+# punctuation people and sites add or leave out, dropped from both sides
+OPTIONAL = re.compile(r"[',!.?:\"]")
+SPACES = re.compile(r'\s+')
+
+
+def normalize(title):
+    """Normalize a title for matching
+    Matching ignores case, curly versus straight quotes, ``&`` versus
+    ``AND`` and the punctuation in ``OPTIONAL`` (apostrophes, including
+    possessive ones, commas, periods, ``!``, ``?``, ``:`` and double quotes).
+    So the title is uppercased, its quotes straightened, ``&`` spelt
+    ``AND``, that punctuation removed and its whitespace collapsed.
+    - ``title``: episode or video title
+
+    returns:
+        ``string``: normalized title
+    """
+    title = title.upper().translate(QUOTES)
+    title = title.replace('&', ' AND ')
+    title = OPTIONAL.sub('', title)
+    return SPACES.sub(' ', title).strip()
+
+
+class TitleMatcher(object):
+    """Finds which normalized episode titles a video title contains
+
+    All titles are combined into one alternation, so a video title that
+    matches none of them costs a single regex search however many episodes
+    are wanted. Only titles that hit are checked one by one.
+    """
+
+    def __init__(self, titles):
+        """Compile the combined alternation
+        - ``titles``: dict of key to normalized title, empty titles never match
+        """
+        self.titles = {key: title for key, title in titles.items() if title}
+        patterns = sorted(set(self.titles.values()), key=len, reverse=True)
+        self.regex = re.compile('|'.join(re.escape(pattern) for pattern in patterns)) if patterns else None
+
+    def search(self, text):
+        """Keys of every title contained in the normalized text"""
+        if self.regex is None or self.regex.search(text) is None:
+            return set()
+        return {key for key, title in self.titles.items() if title in text}
+
+
+def rankmatches(titles, videos):
+    """Match every title against every video in one pass and rank the hits
+    - ``titles``: dict of key to normalized episode title
+    - ``videos``: iterable of (normalized video title, video) in search order
+
+    returns:
+        ``dict``: key mapped to its matching videos, best first. Exact title
+        matches rank first, then videos with the least extra text, then
+        search order.
+    """
+    matcher = TitleMatcher(titles)
+    candidates = {}
+    for position, (text, video) in enumerate(videos):
+        for key in matcher.search(text):
+            rank = (text != titles[key], len(text) - len(titles[key]), position)
+            candidates.setdefault(key, []).append((rank, video))
+    return {
+        key: [video for rank, video in sorted(hits, key=lambda hit: hit[0])]
+        for key, hits in candidates.items()
+    }
@@ -0,0 +1,146 @@
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600, float('inf')]
+
+lock = threading.Lock()
+counters = {}
+gauges = {}
+histograms = {}
+
+
+def key(name, labels):
+    return (name, tuple(sorted((label, str(value)) for label, value in labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter
+    - ``name``: metric name
+    - ``value``: amount to add
+    - ``labels``: metric labels
+    """
+    with lock:
+        counters[key(name, labels)] = counters.get(key(name, labels), 0) + value
+
+
+def setgauge(name, value, **labels):
+    """Set a gauge to the given value"""
+    with lock:
+        gauges[key(name, labels)] = value
+
+
+def observe(name, value, **labels):
+    """Record a value, usually seconds, in a histogram"""
+    with lock:
+        histogram = histograms.setdefault(key(name, labels), {
+            'buckets': [0] * len(BUCKETS),
+            'sum': 0.0,
+            'count': 0,
+        })
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                histogram['buckets'][i] += 1
+        histogram['sum'] += value
+        histogram['count'] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    """Time the wrapped block into a histogram
+    - ``name``: histogram name
+    - ``labels``: metric labels
+    """
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        observe(name, time.monotonic() - start, **labels)
+
+
+def labeltext(labels, extra=None):
+    labels = list(labels) + (extra or [])
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def render():
+    """Metrics in the Prometheus text exposition format"""
+    lines = []
+    typed = set()
+
+    def header(name, kind):
+        if name not in typed:
+            typed.add(name)
+            lines.append('# TYPE sonarr_youtubedl_{} {}'.format(name, kind))
+
+    with lock:
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append('sonarr_youtubedl_{}{} {}'.format(name, labeltext(labels), value))
+        for (name, labels), value in sorted(gauges.items()):
+            header(name, 'gauge')
+            lines.append('sonarr_youtubedl_{}{} {}'.format(name, labeltext(labels), value))
+        for (name, labels), histogram in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, count in zip(BUCKETS, histogram['buckets']):
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append('sonarr_youtubedl_{}_bucket{} {}'.format(name, labeltext(labels, [('le', le)]), count))
+            lines.append('sonarr_youtubedl_{}_sum{} {}'.format(name, labeltext(labels), histogram['sum']))
+            lines.append('sonarr_youtubedl_{}_count{} {}'.format(name, labeltext(labels), histogram['count']))
+    return '\n'.join(lines) + '\n'
+
+
+def snapshot():
+    """Metrics as a json serializable dict"""
+    def entries(store, value=lambda v: v):
+        return [dict(labels, name=name, value=value(v)) for (name, labels), v in sorted(store.items())]
+    with lock:
+        return {
+            'time': time.time(),
+            'counters': entries(counters),
+            'gauges': entries(gauges),
+            'histograms': entries(histograms, lambda h: {'sum': h['sum'], 'count': h['count']}),
+        }
+
+
+def dump(path):
+    """Write ``snapshot`` to a json file"""
+    try:
+        with open(path, 'w') as metricsfile:
+            json.dump(snapshot(), metricsfile, indent=2)
+    except Exception as e:
+        logger.warning('Metrics could not be written to {} - {}'.format(path, e))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('Metrics ' + format % args)
+
+
+def serve(port, host='0.0.0.0'):
+    """Serve /metrics on the given port from a daemon thread"""
+    server = ThreadingHTTPServer((host, int(port)), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Serving metrics on port {}'.format(server.server_address[1]))
+    return server
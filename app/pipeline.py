@@ -0,0 +1,100 @@
+import asyncio
+import logging
+from datetime import datetime
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+
+async def scan(client, series, workers=4, plan=None, urgent=False, wait=True):
+    """Run a scan as overlapping stages joined by bounded queues
+
+    Matched series stream into episode fetching, series with wanted
+    episodes stream into playlist matching, which queues found episodes
+    on the download pool straight away. With ``episode_fetch: missing``
+    the pages of each instance's wanted/missing list stream into episode
+    fetching as they arrive instead. Blocking Sonarr and yt-dlp calls run
+    in the default executor.
+    - ``client``: SonarrYTDL instance
+    - ``series``: series matched by ``filterseries``
+    - ``workers``: series fetched and matched at the same time per stage
+    - ``plan``: list to collect the scan plan in, nothing is downloaded when given
+    - ``urgent``: found episodes go ahead of the downloads already queued
+    - ``wait``: wait for the downloads, False leaves them running once queued
+    """
+    if len(series) == 0:
+        logger.info("Nothing to process")
+        return
+    loop = asyncio.get_running_loop()
+    client.startscan(urgent)
+    now = datetime.utcnow()
+    # webhook scans cover a few series, fetching their episodes beats paging through the whole list
+    missing = client.episode_fetch == 'missing' and not urgent
+    profiles = asyncio.Queue(maxsize=workers * 2)
+    wanted = asyncio.Queue(maxsize=workers * 2)
+
+    async def page(instance):
+        matched = [ser for ser in series if ser['instance'] is instance]
+        pages = client.wantedpages(instance, matched)
+        while True:
+            try:
+                items = await loop.run_in_executor(None, next, pages, None)
+            except Exception as e:
+                logger.error('Sonarr {} wanted/missing list unavailable, its episodes are skipped - {}'.format(
+                    instance.name, e
+                ))
+                return
+            if items is None:
+                return
+            for item in items:
+                await profiles.put(item)
+
+    async def fetch():
+        while True:
+            item = await profiles.get()
+            if item is None:
+                return
+            ser, episodes = item
+            try:
+                episodes = await loop.run_in_executor(None, client.seriesepisodes, ser, now, episodes)
+            except Exception as e:
+                logger.error('{} episodes could not be processed - {}'.format(ser['title'], e))
+                continue
+            if episodes:
+                await wanted.put((ser, episodes))
+
+    async def search():
+        while True:
+            item = await wanted.get()
+            if item is None:
+                return
+            try:
+                await loop.run_in_executor(None, client.searchseries, *item, plan)
+            except Exception as e:
+                logger.error('{} could not be searched - {}'.format(item[0]['title'], e))
+
+    logger.info("Processing Wanted Downloads")
+    fetchers = [asyncio.create_task(fetch()) for _ in range(workers)]
+    searchers = [asyncio.create_task(search()) for _ in range(workers)]
+    try:
+        if missing:
+            instances = {ser['instance'].name: ser['instance'] for ser in series}
+            await asyncio.gather(*[page(instance) for instance in instances.values()])
+        else:
+            for ser in series:
+                await profiles.put((ser, None))
+        for _ in fetchers:
+            await profiles.put(None)
+        await asyncio.gather(*fetchers)
+        for _ in searchers:
+            await wanted.put(None)
+        await asyncio.gather(*searchers)
+    finally:
+        # a failed stage leaves nothing draining the queues, stop the rest instead of blocking on them
+        for task in fetchers + searchers:
+            task.cancel()
+        await asyncio.gather(*fetchers, *searchers, return_exceptions=True)
+    if plan is None:
+        await loop.run_in_executor(None, client.finishscan, wait)
+    else:
+        await loop.run_in_executor(None, client.playlistcache.save)
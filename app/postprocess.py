@@ -0,0 +1,151 @@
+import time
+import logging
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+import yt_dlp
+from yt_dlp.postprocessor import get_postprocessor
+import metrics
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+
+def defer(ydl, deferred):
+    """Leave the postprocessing of a YoutubeDL's download to a ``PostprocessPool``
+    yt-dlp runs merges, fixups and the configured postprocessors from
+    ``post_process`` once the streams are on disk. This instance's
+    ``post_process`` only records what it would have run, so the download
+    returns as soon as the transfer is done.
+    - ``ydl``: YoutubeDL about to download
+    - ``deferred``: dict filled with what ``postprocess`` needs, left empty
+      when nothing was downloaded
+    """
+    def post_process(filename, info, files_to_move=None):
+        deferred.update({
+            'filename': filename,
+            'postprocessors': [pp.pp_key() for pp in info.get('__postprocessors') or []],
+            'files_to_move': files_to_move or {},
+            'info': ydl.sanitize_info({key: value for key, value in info.items() if key != '__postprocessors'}),
+        })
+        info['filepath'] = filename
+        return info
+
+    ydl.post_process = post_process
+
+
+def postprocess(options, filename, info, postprocessors, files_to_move):
+    """Run the deferred postprocessing of one download, in a pool process
+    - ``options``: Youtube-dl options of the download
+    - ``filename``, ``info``, ``postprocessors``, ``files_to_move``: recorded by ``defer``
+    returns:
+        ``string``: path of the final file
+    """
+    with yt_dlp.YoutubeDL(options) as ydl:
+        info['__postprocessors'] = [get_postprocessor(key)(ydl) for key in postprocessors]
+        info = ydl.post_process(filename, info, files_to_move)
+    return info.get('filepath')
+
+
+class PostprocessPool(object):
+    """Process pool for ffmpeg merges, subtitle conversion and embedding
+
+    Downloads hand their postprocessing over and free their download slot,
+    while ffmpeg work runs in parallel on up to ``workers`` cores. Workers
+    start from a fork server, not a fork of the threaded daemon.
+
+    A download ``hold``s the pool it will submit to until it has submitted
+    or given up. A ``retire``d pool takes no new holders and shuts down in the
+    background once the last one is released.
+    """
+
+    def __init__(self, workers=1):
+        self.workers = max(1, int(workers))
+        self.pool = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=multiprocessing.get_context('forkserver')
+        )
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.holders = 0
+        self.retired = False
+        self.closed = False
+        logger.debug('Postprocessing pool using {} processes'.format(self.workers))
+
+    def submit(self, options, deferred, callback, series=''):
+        """Queue the postprocessing recorded by ``defer``
+        - ``options``: Youtube-dl options of the download, json serializable
+        - ``deferred``: dict filled by ``defer``
+        - ``callback``: called with None once the final file is in place, or with the error,
+          also when the pool cannot take the work (broken or shut down)
+        - ``series``: series title, for metrics
+        """
+        start = time.monotonic()
+        finished = Future()
+
+        def done(future):
+            error = future.exception()
+            metrics.observe('stage_seconds', time.monotonic() - start, stage='postprocess', series=series)
+            try:
+                callback(error)
+            finally:
+                finished.set_result(error)
+                with self.lock:
+                    self.pending.discard(finished)
+
+        try:
+            future = self.pool.submit(
+                postprocess,
+                options,
+                deferred['filename'],
+                deferred['info'],
+                deferred['postprocessors'],
+                deferred['files_to_move']
+            )
+        except Exception as e:
+            logger.error('Postprocessing pool unavailable - {}'.format(e))
+            callback(e)
+            return
+        with self.lock:
+            self.pending.add(finished)
+        future.add_done_callback(done)
+
+    def hold(self):
+        """Keep the pool open for a download that may submit to it, see ``release``
+        returns:
+            ``bool``: False if the pool was retired, use its replacement instead
+        """
+        with self.lock:
+            if self.retired:
+                return False
+            self.holders += 1
+            return True
+
+    def release(self):
+        with self.lock:
+            self.holders -= 1
+            idle = self.retired and self.holders == 0
+        if idle:
+            self.close()
+
+    def retire(self):
+        """Stop taking holders, shutting down once the downloads holding the pool are done"""
+        with self.lock:
+            self.retired = True
+            idle = self.holders == 0
+        if idle:
+            self.close()
+
+    def close(self):
+        threading.Thread(target=self.shutdown, name='postprocess-drain', daemon=True).start()
+
+    def wait(self):
+        """Block until every postprocessing queued so far has finished and been reported"""
+        with self.lock:
+            pending = list(self.pending)
+        wait(pending)
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown()
+        self.closed = True
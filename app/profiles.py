@@ -0,0 +1,111 @@
+import re
+import logging
+from utils import offsetdelta, parsebytes
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+
+def normalizetitle(title):
+    """Lowercase a title and strip punctuation so small edits still match
+    - ``title``: series title from Sonarr or config.yml
+
+    returns:
+        ``string``: normalized title
+    """
+    title = title.lower().replace('&', ' and ')
+    title = re.sub(r"['’`]", '', title)
+    title = re.sub(r'[^0-9a-z]+', ' ', title)
+    return title.strip()
+
+
+class SeriesProfile(object):
+    """A series entry of config.yml, parsed and compiled once"""
+
+    __slots__ = [
+        'title', 'url', 'tvdb_id', 'sonarr_id', 'offset', 'cookies_file', 'format',
+        'playlistreverse', 'subtitles', 'subtitles_languages', 'subtitles_autogenerated',
+        'sonarr_regex', 'sonarr_replace', 'site_regex', 'site_replace',
+        'concurrent_fragments', 'http_chunk_size', 'priority',
+    ]
+
+    def __init__(self, wnt):
+        """Parse a series entry
+        - ``wnt``: series entry from config.yml
+        """
+        self.title = wnt['title']
+        self.url = wnt['url']
+        self.tvdb_id = int(wnt['tvdb_id']) if 'tvdb_id' in wnt else None
+        self.sonarr_id = int(wnt['sonarr_id']) if 'sonarr_id' in wnt else None
+        self.offset = offsetdelta(wnt['offset']) if 'offset' in wnt else None
+        self.cookies_file = wnt.get('cookies_file')
+        self.format = wnt.get('format')
+        self.playlistreverse = str(wnt.get('playlistreverse', 'True')).lower() != 'false'
+        self.concurrent_fragments = int(wnt['concurrent_fragments']) if 'concurrent_fragments' in wnt else None
+        self.http_chunk_size = parsebytes(wnt['http_chunk_size']) if 'http_chunk_size' in wnt else None
+        self.priority = int(wnt.get('priority', 0))
+        self.subtitles = 'subtitles' in wnt
+        self.subtitles_languages = ['en']
+        self.subtitles_autogenerated = False
+        if self.subtitles:
+            self.subtitles_languages = wnt['subtitles'].get('languages', self.subtitles_languages)
+            self.subtitles_autogenerated = wnt['subtitles'].get('autogenerated', self.subtitles_autogenerated)
+        self.sonarr_regex = None
+        self.sonarr_replace = ''
+        self.site_regex = None
+        self.site_replace = ''
+        regex = wnt.get('regex', {})
+        if 'sonarr' in regex:
+            self.sonarr_regex = re.compile(regex['sonarr']['match'])
+            self.sonarr_replace = regex['sonarr']['replace']
+        if 'site' in regex:
+            self.site_regex = re.compile(regex['site']['match'])
+            self.site_replace = regex['site']['replace']
+
+    def episodetitle(self, title):
+        """Episode title from Sonarr with the sonarr regex applied"""
+        if self.sonarr_regex is None:
+            return title
+        return self.sonarr_regex.sub(self.sonarr_replace, title)
+
+    def sitetitle(self, title):
+        """Video title from the site with the site regex applied"""
+        if self.site_regex is None:
+            return title
+        return self.site_regex.sub(self.site_replace, title)
+
+
+class ProfileIndex(object):
+    """Looks up series profiles by Sonarr id, tvdbId or normalized title"""
+
+    def __init__(self, series):
+        """Parse every series entry of config.yml
+        - ``series``: list of series entries from config.yml
+        """
+        self.profiles = []
+        self.by_title = {}
+        self.by_tvdb_id = {}
+        self.by_sonarr_id = {}
+        for wnt in series:
+            try:
+                profile = SeriesProfile(wnt)
+            except (KeyError, ValueError, TypeError, AttributeError, re.error) as e:
+                logger.error('Series entry {} in config.yml is invalid - {}'.format(wnt.get('title', wnt), e))
+                continue
+            self.profiles.append(profile)
+            self.by_title.setdefault(normalizetitle(profile.title), []).append(profile)
+            if profile.tvdb_id is not None:
+                self.by_tvdb_id.setdefault(profile.tvdb_id, []).append(profile)
+            if profile.sonarr_id is not None:
+                self.by_sonarr_id.setdefault(profile.sonarr_id, []).append(profile)
+
+    def match(self, ser):
+        """Profiles configured for a Sonarr series
+        - ``ser``: series from Sonarr
+        returns:
+            ``list``: matching profiles, ids take precedence over the title
+        """
+        for key, index in [('id', self.by_sonarr_id), ('tvdbId', self.by_tvdb_id)]:
+            if ser.get(key) in index:
+                return index[ser[key]]
+        return self.by_title.get(normalizetitle(ser['title']), [])
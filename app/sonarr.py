@@ -0,0 +1,516 @@
+import re
+import json
+import time
+import codecs
+import logging
+import threading
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+
+class Record(object):
+    """Compact copy of a Sonarr json object keeping only the fields in ``__slots__``
+
+    Sonarr objects carry images, statistics, seasons and more for every
+    series, none of which a scan reads. Fields are read the way the json
+    dicts were (``ser['title']``, ``ser.get('tvdbId')``), missing ones are None.
+    """
+
+    __slots__ = []
+
+    def __init__(self, data=None, **fields):
+        """Copy the kept fields
+        - ``data``: json object from Sonarr
+        - ``fields``: fields to set on top of data
+        """
+        data = data or {}
+        for field in self.__slots__:
+            setattr(self, field, fields[field] if field in fields else data.get(field))
+
+    def __getitem__(self, field):
+        try:
+            return getattr(self, field)
+        except AttributeError:
+            raise KeyError(field)
+
+    def __setitem__(self, field, value):
+        setattr(self, field, value)
+
+    def __contains__(self, field):
+        return getattr(self, field, None) is not None
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None)
+        return default if value is None else value
+
+    def copy(self, **fields):
+        """New record with the same fields, some replaced"""
+        return type(self)(self, **fields)
+
+    def asdict(self):
+        """The fields that are set, as a json serializable dict"""
+        return {field: getattr(self, field) for field in self.__slots__ if getattr(self, field) is not None}
+
+
+def seriesrevision(data):
+    """Fingerprint of a Sonarr series json object that changes with its episodes
+    Sonarr bumps ``lastInfoSync`` when it refreshes the episode list, and the
+    statistics and monitoring flags change when files arrive or episodes are
+    (un)monitored.
+    """
+    statistics = data.get('statistics') or {}
+    return '{}|{}|{}|{}|{}|{}|{}'.format(
+        data.get('lastInfoSync'),
+        data.get('monitored'),
+        ''.join('1' if season.get('monitored') else '0' for season in data.get('seasons') or []),
+        statistics.get('episodeCount'),
+        statistics.get('episodeFileCount'),
+        statistics.get('totalEpisodeCount'),
+        statistics.get('sizeOnDisk'),
+    )
+
+
+class Series(Record):
+    """Sonarr series, with the ``profile`` and ``instance`` it is matched to
+    ``revision`` is the ``seriesrevision`` of the json it was made from.
+    """
+
+    __slots__ = ['id', 'title', 'path', 'monitored', 'tvdbId', 'revision', 'profile', 'instance']
+
+    def __init__(self, data=None, **fields):
+        super(Series, self).__init__(data, **fields)
+        if self.revision is None and isinstance(data, dict):
+            self.revision = seriesrevision(data)
+
+
+class Episode(Record):
+    """Sonarr episode, with the name of the ``instance`` it comes from"""
+
+    __slots__ = [
+        'id', 'seriesId', 'seasonNumber', 'episodeNumber', 'title',
+        'airDateUtc', 'monitored', 'hasFile', 'instance',
+    ]
+
+
+def iterarray(res, chunk_size=65536):
+    """Yield the items of a json array response while it downloads
+    Only the undecoded rest of the current chunk and one item are held in
+    memory, never the whole array. An item is only taken once input follows
+    it, so numbers and literals split across chunks decode whole.
+    - ``res``: streamed response holding a json array
+    - ``chunk_size``: bytes read from the response at a time
+
+    raises:
+        ``requests.exceptions.InvalidJSONError``: the body is not a complete json array
+    """
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder(res.encoding or 'utf-8')()
+    chunks = res.iter_content(chunk_size=chunk_size)
+    buffer = ''
+    pos = 0
+    # what comes next: '[' to open, 'first' item or ']', 'item' after a comma, 'separator' after an item
+    expect = '['
+    done = False
+    with res:
+        while True:
+            while pos < len(buffer) and buffer[pos].isspace():
+                pos += 1
+            if pos < len(buffer):
+                char = buffer[pos]
+                if expect == '[':
+                    if char != '[':
+                        raise requests.exceptions.InvalidJSONError(
+                            'Expected a json array from {}'.format(res.url), response=res
+                        )
+                    expect = 'first'
+                    pos += 1
+                    continue
+                if expect == 'separator' and char not in ',]':
+                    raise requests.exceptions.InvalidJSONError(
+                        "Expected ',' or ']' in json array from {}".format(res.url), response=res
+                    )
+                if char == ']' and expect in ('first', 'separator'):
+                    return
+                if char == ',' and expect == 'separator':
+                    expect = 'item'
+                    pos += 1
+                    continue
+                try:
+                    item, end = decoder.raw_decode(buffer, pos)
+                except ValueError as e:
+                    if done:
+                        raise requests.exceptions.InvalidJSONError(
+                            'Invalid json array from {} - {}'.format(res.url, e), response=res
+                        )
+                else:
+                    if end < len(buffer) or done:
+                        yield item
+                        pos = end
+                        expect = 'separator'
+                        continue
+            if done:
+                raise requests.exceptions.InvalidJSONError(
+                    'Truncated json array from {}'.format(res.url), response=res
+                )
+            buffer = buffer[pos:]
+            pos = 0
+            chunk = next(chunks, None)
+            try:
+                if chunk is None:
+                    done = True
+                    buffer += text.decode(b'', final=True)
+                else:
+                    buffer += text.decode(chunk)
+            except UnicodeDecodeError as e:
+                raise requests.exceptions.InvalidJSONError(
+                    'Invalid text from {} - {}'.format(res.url, e), response=res
+                )
+
+
+class SonarrClient(object):
+    """Sonarr API client sharing one pooled keep-alive session"""
+
+    def __init__(self, base_url, api_version, api_key, timeout=30, retries=3):
+        """Set up the session, ``cache`` can be set to a ``ResponseCache`` afterwards
+        - ``base_url``: scheme, host, port and basedir of Sonarr
+        - ``api_version``: api path, ``api`` or ``api/v3``
+        - ``api_key``: Sonarr api key, sent as the X-Api-Key header
+        - ``timeout``: seconds to wait for Sonarr to connect or answer
+        - ``retries``: attempts on connection errors and 5xx responses
+        """
+        self.base_url = base_url
+        self.sonarr_api_version = api_version
+        self.cache = None
+        self.timeout = float(timeout)
+        retry = Retry(
+            total=int(retries),
+            connect=int(retries),
+            read=int(retries),
+            status=int(retries),
+            backoff_factor=1,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=['GET', 'POST'],
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=1, pool_maxsize=10)
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.session.headers.update({
+            'X-Api-Key': api_key,
+            'Accept': 'application/json',
+        })
+
+    def endpoint(self, *path):
+        """Full url of an api endpoint
+        - ``path``: path parts after the api version
+        """
+        return '/'.join([self.base_url, self.sonarr_api_version] + [str(part) for part in path])
+
+    def request(self, method, url, **kwargs):
+        """Send a request through the session, recording its count and latency"""
+        endpoint = re.sub(r'/\d+(?=/|$)', '/:id', url[len(self.endpoint()):]) or '/'
+        start = time.monotonic()
+        try:
+            res = self.session.request(method, url, timeout=self.timeout, **kwargs)
+        except requests.exceptions.RequestException:
+            metrics.inc('sonarr_requests_total', method=method, endpoint=endpoint, status='error')
+            raise
+        finally:
+            metrics.observe('sonarr_request_seconds', time.monotonic() - start, method=method, endpoint=endpoint)
+        metrics.inc('sonarr_requests_total', method=method, endpoint=endpoint, status=res.status_code)
+        res.raise_for_status()
+        return res
+
+    def get_episodes_by_series_id(self, series_id, revision=None):
+        """Yields every episode of the given series as an ``Episode``, parsed while it downloads
+        - ``revision``: ``revision`` of the series, cached episodes are only used while it matches
+        """
+        key = '{}?seriesId={}'.format(self.endpoint('episode'), series_id)
+        cacheable = self.cache is not None and self.cache.enabled('episode')
+        cached = self.cache.get('episode', key, revision) if cacheable else None
+        if cached is not None:
+            logger.debug('Using cached episodes for series_id: {}'.format(series_id))
+            for eps in cached:
+                yield Episode(eps)
+            return
+        logger.debug('Begin call Sonarr for all episodes for series_id: {}'.format(series_id))
+        res = self.request_get(self.endpoint('episode'), {'seriesId': series_id}, stream=True)
+        episodes = []
+        for eps in iterarray(res):
+            eps = Episode(eps)
+            if cacheable:
+                episodes.append(eps.asdict())
+            yield eps
+        if cacheable:
+            self.cache.put('episode', key, episodes, revision)
+
+    def get_episode_files_by_series_id(self, series_id):
+        """Returns all episode files for the given series"""
+        res = self.request_get(self.endpoint('episodefile'), {'seriesId': series_id})
+        return res.json()
+
+    def get_wanted_missing_pages(self, page_size=250):
+        """Yields every monitored, aired episode without a file, a page at a time
+        Pages are lists of ``Episode``, newest aired first.
+        - ``page_size``: episodes requested per page
+        """
+        page = 1
+        while True:
+            logger.debug('Begin call Sonarr for wanted/missing page: {}'.format(page))
+            res = self.request_get(self.endpoint('wanted', 'missing'), {
+                'page': page,
+                'pageSize': page_size,
+                'sortKey': 'airDateUtc',
+                'sortDirection': 'descending',
+                'monitored': 'true',
+            })
+            data = res.json()
+            records = data.get('records', [])
+            yield [Episode(eps) for eps in records]
+            if len(records) < page_size or page * page_size >= data.get('totalRecords', 0):
+                return
+            page += 1
+
+    def get_series(self):
+        """Yields every series in your collection as a ``Series``, parsed while it downloads"""
+        key = self.endpoint('series')
+        # the full listing is only held when it is cached
+        cacheable = self.cache is not None and self.cache.enabled('series')
+        cached = self.cache.get('series', key) if cacheable else None
+        if cached is not None:
+            logger.debug('Using cached series list')
+            for ser in cached:
+                yield Series(**ser)
+            return
+        logger.debug('Begin call Sonarr for all available series')
+        res = self.request_get(self.endpoint('series'), stream=True)
+        series = []
+        for ser in iterarray(res):
+            ser = Series(ser)
+            if cacheable:
+                series.append(ser.asdict())
+            yield ser
+        if cacheable:
+            self.cache.put('series', key, series)
+
+    def get_series_by_series_id(self, series_id):
+        """Return the series with the matching ID or 404 if no matching series is found"""
+        logger.debug('Begin call Sonarr for specific series series_id: {}'.format(series_id))
+        res = self.request_get(self.endpoint('series', series_id))
+        return Series(res.json())
+
+    def request_get(self, url, params=None, stream=False):
+        """Wrapper on the session get, raises for error responses
+        - ``stream``: leave the body to be read from the response as it arrives
+        """
+        logger.debug('Begin GET with url: {}'.format(url))
+        if params is not None:
+            logger.debug('Begin GET with params: {}'.format(params))
+        return self.request('GET', url, params=params, stream=stream)
+
+    def request_put(self, url, params=None, jsondata=None):
+        """Wrapper on the session post, raises for error responses"""
+        logger.debug('Begin PUT with url: {}'.format(url))
+        if params is not None:
+            logger.debug('Begin PUT with params: {}'.format(params))
+        return self.request('POST', url, params=params, json=jsondata)
+
+    def invalidate(self, series_id):
+        """Drop the cached responses that a change to the series makes stale"""
+        if self.cache is not None:
+            self.cache.invalidate('series', self.endpoint('series'))
+            self.cache.invalidate('episode', '{}?seriesId={}'.format(self.endpoint('episode'), series_id))
+
+    def rescanseries(self, series_id):
+        """Refresh series information from trakt and rescan disk"""
+        logger.debug('Begin call Sonarr to rescan for series_id: {}'.format(series_id))
+        self.invalidate(series_id)
+        data = {
+            "name": "RescanSeries",
+            "seriesId": str(series_id)
+        }
+        res = self.request_put(self.endpoint('command'), None, data)
+        return res.json()
+
+    def get_command(self, command_id):
+        """Return the status of a previously sent command"""
+        res = self.request_get(self.endpoint('command', command_id))
+        return res.json()
+
+
+class RescanQueue(object):
+    """Collects RescanSeries requests so each series is rescanned once
+
+    A rescan is sent when the last outstanding download of a series has
+    finished and no other download for it finished within ``debounce``
+    seconds. ``flush`` sends anything still waiting. Sent commands are
+    followed through Sonarr's command endpoint every ``interval`` seconds
+    in the background until they finish, ``wait`` blocks until they have.
+    """
+
+    FINISHED = ['completed', 'failed', 'aborted', 'cancelled', 'orphaned']
+
+    def __init__(self, client, debounce=30, interval=2, timeout=600):
+        """Set up the queue
+        - ``client``: ``SonarrClient`` to send the rescans with
+        - ``debounce``: seconds to wait for more downloads of a series before rescanning it
+        - ``interval``: seconds between checks of the sent commands
+        - ``timeout``: seconds a sent command is followed before it is given up on
+        """
+        self.client = client
+        self.debounce = float(debounce)
+        self.interval = float(interval)
+        self.timeout = float(timeout)
+        self.lock = threading.Lock()
+        self.outstanding = {}
+        self.requested = set()
+        self.timers = {}
+        self.commands = {}
+        self.poller = None
+
+    def expect(self, series_id):
+        """Note a download for the series has been queued"""
+        with self.lock:
+            self.outstanding[series_id] = self.outstanding.get(series_id, 0) + 1
+            self.canceltimer(series_id)
+
+    def done(self, series_id, downloaded=True):
+        """Note a queued download for the series has finished
+        - ``series_id``: Sonarr series id
+        - ``downloaded``: the episode landed on disk and needs importing
+        """
+        with self.lock:
+            self.outstanding[series_id] = max(0, self.outstanding.get(series_id, 0) - 1)
+            if downloaded:
+                self.requested.add(series_id)
+            if self.outstanding[series_id] > 0 or series_id not in self.requested:
+                return
+            self.canceltimer(series_id)
+            if self.debounce > 0:
+                timer = threading.Timer(self.debounce, self.flush, [series_id])
+                timer.daemon = True
+                self.timers[series_id] = timer
+                timer.start()
+                return
+        self.flush(series_id)
+
+    def canceltimer(self, series_id):
+        timer = self.timers.pop(series_id, None)
+        if timer is not None:
+            timer.cancel()
+
+    def flush(self, series_id=None):
+        """Send the waiting rescans
+        - ``series_id``: only send this series, every waiting series if None
+        """
+        with self.lock:
+            if series_id is None:
+                send = list(self.requested)
+            else:
+                send = [series_id] if series_id in self.requested else []
+            for ser_id in send:
+                self.canceltimer(ser_id)
+                self.requested.discard(ser_id)
+        for ser_id in send:
+            try:
+                command = self.client.rescanseries(ser_id)
+            except requests.exceptions.RequestException as e:
+                logger.error('Rescan of series_id {} failed - {}'.format(ser_id, e))
+                continue
+            with self.lock:
+                self.commands[command['id']] = (ser_id, time.monotonic())
+        self.follow()
+
+    def follow(self):
+        """Poll the sent commands in the background, unless that is already happening"""
+        with self.lock:
+            if self.poller is not None or not self.commands:
+                return
+            self.poller = threading.Timer(self.interval, self.followed)
+            self.poller.daemon = True
+            self.poller.start()
+
+    def followed(self):
+        self.poll()
+        with self.lock:
+            self.poller = None
+        # commands sent while polling are picked up here
+        self.follow()
+
+    def poll(self):
+        """Check the sent commands once, forgetting the ones Sonarr reports finished
+        returns:
+            ``int``: commands still running
+        """
+        with self.lock:
+            commands = dict(self.commands)
+        for command_id, (ser_id, sent) in commands.items():
+            try:
+                status = self.client.get_command(command_id).get('status', '').lower()
+            except requests.exceptions.RequestException as e:
+                logger.warning('Rescan status for series_id {} unavailable - {}'.format(ser_id, e))
+                status = 'orphaned'
+            if status in self.FINISHED:
+                with self.lock:
+                    if self.commands.pop(command_id, None) is None:
+                        # a concurrent poll already reported it
+                        continue
+                metrics.observe('stage_seconds', time.monotonic() - sent, stage='rescan')
+                if status == 'completed':
+                    logger.debug('Rescan of series_id {} completed'.format(ser_id))
+                else:
+                    logger.warning('Rescan of series_id {} {}'.format(ser_id, status))
+            elif time.monotonic() - sent > self.timeout:
+                with self.lock:
+                    self.commands.pop(command_id, None)
+                logger.warning('Rescan of series_id {} still {} after {:.0f}s, no longer followed'.format(
+                    ser_id,
+                    status or 'unknown',
+                    self.timeout
+                ))
+        with self.lock:
+            return len(self.commands)
+
+    def wait(self, timeout=120, interval=2):
+        """Poll the sent commands until Sonarr reports them finished
+        - ``timeout``: seconds to keep polling before giving up
+        - ``interval``: seconds between polls
+        """
+        deadline = time.time() + timeout
+        while True:
+            running = self.poll()
+            if not running:
+                return
+            if time.time() >= deadline:
+                logger.warning('{} rescans still running in Sonarr'.format(running))
+                return
+            time.sleep(interval)
+
+
+class SonarrInstance(object):
+    """One Sonarr server, with the config.yml series mapped to it
+
+    Series ids only mean something within their instance, so jobs, misses
+    and rescans carry the instance name alongside them.
+    """
+
+    def __init__(self, name, settings):
+        """Connect to the instance
+        - ``name``: name from config.yml, empty for a single unnamed instance
+        - ``settings``: ``SonarrClient`` arguments
+        """
+        self.name = name
+        self.settings = settings
+        self.client = SonarrClient(*settings)
+        self.rescans = RescanQueue(self.client)
+        self.profiles = None
+
+    def key(self, series_id):
+        """Series id made unique across instances"""
+        return '{}/{}'.format(self.name, series_id) if self.name else series_id
@@ -1,264 +1,379 @@
 import requests
-import urllib.parse
 import yt_dlp
 import os
 import sys
 import re
-from utils import upperescape, checkconfig, offsethandler, YoutubeDLLogger, ytdl_hooks, ytdl_hooks_debug, setup_logging  # NOQA
+import json
+import yaml
+import metrics
+from utils import checkconfig, parsebytes, partialbytes, YoutubeDLLogger, ytdl_hooks, ytdl_hooks_debug, setup_logging  # NOQA
+from cache import PlaylistCache, MissCache, ResponseCache, newestfirst
+from jobs import JobStore
+from matcher import normalize, rankmatches
+from downloader import DownloadScheduler, parseorder
+from bandwidth import BandwidthManager, parserate, parseschedule
+from postprocess import PostprocessPool, defer
+from profiles import ProfileIndex
+from sonarr import SonarrInstance
+from webhook import WebhookListener
+from pipeline import scan
 from datetime import datetime
 import schedule
 import time
+import calendar
 import logging
+import threading
 import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 # allow debug arg for verbose logging
 parser = argparse.ArgumentParser(description='Process some integers.')
 parser.add_argument('--debug', action='store_true', help='Enable debug logging')
+parser.add_argument('--plan', nargs='?', const='-', metavar='FILE', help='Write what a scan would download as json (to FILE or stdout) and exit, downloading nothing')
 args = parser.parse_args()
 
 # setup logger
 logger = setup_logging(True, True, args.debug)
 
 date_format = "%Y-%m-%dT%H:%M:%SZ"
-now = datetime.now()
 
 CONFIGFILE = os.environ['CONFIGPATH']
 CONFIGPATH = CONFIGFILE.replace('config.yml', '')
 SCANINTERVAL = 60
+WEBHOOKPORT = 0
+WEBHOOKAPIKEY = None
+# seconds a resolved info dict is trusted before its signed urls may have expired
+RESOLVEDTTL = 1800
+# seconds to wait before the first retry of a failed download, growing with each retry
+RETRYDELAY = 10
 
 
 class SonarrYTDL(object):
 
     def __init__(self):
         """Set up app with config file settings"""
-        cfg = checkconfig()
+        self.config_mtime = None
+        self.playlistcache = None
+        self.misscache = None
+        self.jobs = JobStore(CONFIGPATH + 'jobs.db')
+        self.downloads = None
+        self.bandwidth = None
+        self.postprocess = None
+        self.retiredpools = []
+        self.sonarrcache = None
+        self.sonarrcache_settings = None
+        self.instances = {}
+        self.playlistlocks = {}
+        self.playlistlocks_lock = threading.Lock()
+        self.scanstarted = time.time()
+        self.urgent = False
+        self.configure(checkconfig())
+
+    def reload(self):
+        """Re-read config.yml if it changed since it was last loaded
+        State such as the playlist cache, download pool and Sonarr session
+        is kept unless the settings it depends on changed.
+        returns:
+            ``bool``: True if the config was reloaded
+        """
+        try:
+            mtime = os.path.getmtime(CONFIGFILE)
+        except OSError:
+            return False
+        if mtime == self.config_mtime:
+            return False
+        logger.info('config.yml changed, reloading')
+        try:
+            self.configure(checkconfig())
+        except (SystemExit, yaml.YAMLError) as e:
+            logger.error('Reload of config.yml failed, keeping previous settings - {}'.format(e))
+            self.config_mtime = mtime
+            return False
+        return True
+
+    def configure(self, cfg):
+        """Apply config file settings
+        Every section is parsed before anything is applied, so a config.yml
+        with an invalid value leaves the settings in use untouched.
+        - ``cfg``: dict from ``checkconfig``
+        """
+        settings = self.parseconfig(cfg)
+        self.config_mtime = os.path.getmtime(CONFIGFILE)
 
         # Sonarr_YTDL Setup
+        self.set_scan_interval(settings['scan_interval'])
+        self.set_webhook(settings['webhook_port'], settings['webhook_apikey'])
+        if self.playlistcache is None:
+            self.playlistcache = PlaylistCache(CONFIGPATH + 'playlist_cache.json', settings['playlist_cache_ttl'])
+        else:
+            self.playlistcache.ttl = settings['playlist_cache_ttl'] * 60
+        if self.misscache is None:
+            self.misscache = MissCache(CONFIGPATH + 'miss_cache.json', settings['miss_backoff'], settings['miss_backoff_max'])
+        else:
+            self.misscache.backoff = settings['miss_backoff'] * 60
+            self.misscache.maximum = settings['miss_backoff_max'] * 60
+        if settings['sonarrcache'] != self.sonarrcache_settings:
+            if self.sonarrcache is not None:
+                self.sonarrcache.save()
+            ttl_series, ttl_episodes, cache_size, cache_spill = settings['sonarrcache']
+            self.sonarrcache = ResponseCache(
+                {'series': ttl_series, 'episode': ttl_episodes},
+                cache_size,
+                CONFIGPATH + 'sonarr_cache.db' if cache_spill else None
+            )
+            self.sonarrcache_settings = settings['sonarrcache']
+        max_downloads, max_per_site, download_order = settings['downloads']
+        if self.downloads is None or (self.downloads.max_downloads, self.downloads.max_per_site, self.downloads.order) != settings['downloads']:
+            downloads = DownloadScheduler(max_downloads, max_per_site, download_order, self.resolveepisode)
+            if self.downloads is not None:
+                # queued downloads move over, running ones finish without holding up the reload
+                downloads.adopt(self.downloads)
+            self.downloads = downloads
+        postprocess_workers = settings['postprocess_workers']
+        if (self.postprocess.workers if self.postprocess is not None else 0) != postprocess_workers:
+            retired = self.postprocess
+            self.postprocess = PostprocessPool(postprocess_workers) if postprocess_workers > 0 else None
+            if retired is not None:
+                # running downloads still hand their work to the old pool, it shuts down once they are done
+                self.retiredpools.append(retired)
+                retired.retire()
+        if self.bandwidth is None:
+            self.bandwidth = BandwidthManager(settings['bandwidth_limit'], settings['bandwidth_schedule'])
+        else:
+            self.bandwidth.configure(settings['bandwidth_limit'], settings['bandwidth_schedule'])
+        self.episode_fetch = settings['episode_fetch']
+        self.scan_workers = settings['scan_workers']
+        self.download_retries = settings['download_retries']
+        self.metrics_port = settings['metrics_port']
+        self.metrics_dump = settings['metrics_dump']
+        self.debug = settings['debug']
+        level = logging.DEBUG if self.debug or args.debug else logging.INFO
+        logger.setLevel(level)
+        for logs in logger.handlers:
+            if logs.name == 'FileHandler':
+                logs.setLevel(level)
+            if logs.name == 'StreamHandler':
+                logs.setLevel(level)
+        if self.debug:
+            logger.debug('DEBUGGING ENABLED')
+
+        # Sonarr Setup
+        instances = {}
+        for name, (sonarr_settings, profiles) in settings['instances'].items():
+            instance = self.instances.get(name)
+            if instance is None or instance.settings != sonarr_settings:
+                instance = SonarrInstance(name, sonarr_settings)
+            instance.client.cache = self.sonarrcache
+            instance.rescans.debounce = settings['rescan_debounce']
+            instance.profiles = profiles
+            instances[name] = instance
+        self.instances = instances
+
+        # YTDL Setup
+        self.ytdl_format = settings['ytdl_format']
+        self.concurrent_fragments = settings['concurrent_fragments']
+        self.http_chunk_size = settings['http_chunk_size']
+
+    def parseconfig(self, cfg):
+        """Parse and check config file settings without applying any
+        - ``cfg``: dict from ``checkconfig``
+        returns:
+            ``dict``: settings for ``configure``, exits naming the section of an invalid value
+        """
+        settings = {}
 
+        # Sonarr_YTDL Setup
         try:
-            self.set_scan_interval(cfg['sonarrytdl']['scan_interval'])
-            try:
-                self.debug = cfg['sonarrytdl']['debug'] in ['true', 'True']
-                if self.debug:
-                    logger.setLevel(logging.DEBUG)
-                    for logs in logger.handlers:
-                        if logs.name == 'FileHandler':
-                            logs.setLevel(logging.DEBUG)
-                        if logs.name == 'StreamHandler':
-                            logs.setLevel(logging.DEBUG)
-                    logger.debug('DEBUGGING ENABLED')
-            except AttributeError:
-                self.debug = False
+            sonarrytdl = cfg['sonarrytdl']
+            settings['scan_interval'] = sonarrytdl['scan_interval']
+            settings['webhook_port'] = int(sonarrytdl.get('webhook_port', 0))
+            settings['webhook_apikey'] = sonarrytdl.get('webhook_apikey')
+            settings['playlist_cache_ttl'] = int(sonarrytdl.get('playlist_cache_ttl', 1440))
+            settings['miss_backoff'] = int(sonarrytdl.get('miss_backoff', 60))
+            settings['miss_backoff_max'] = int(sonarrytdl.get('miss_backoff_max', 10080))
+            settings['sonarrcache'] = (
+                int(sonarrytdl.get('sonarr_cache_ttl_series', 0)),
+                int(sonarrytdl.get('sonarr_cache_ttl_episodes', 360)),
+                int(sonarrytdl.get('sonarr_cache_size', 1000)),
+                str(sonarrytdl.get('sonarr_cache_spill', 'False')).lower() == 'true',
+            )
+            settings['downloads'] = (
+                max(1, int(sonarrytdl.get('max_downloads', 1))),
+                max(1, int(sonarrytdl.get('max_downloads_per_site', 1))),
+                parseorder(sonarrytdl.get('download_order')),
+            )
+            settings['postprocess_workers'] = int(sonarrytdl.get('postprocess_workers', os.cpu_count() or 1))
+            settings['bandwidth_limit'] = sonarrytdl.get('bandwidth_limit')
+            settings['bandwidth_schedule'] = sonarrytdl.get('bandwidth_schedule')
+            parserate(settings['bandwidth_limit'])
+            parseschedule(settings['bandwidth_schedule'])
+            settings['episode_fetch'] = sonarrytdl.get('episode_fetch', 'series').lower()
+            settings['scan_workers'] = max(1, int(sonarrytdl.get('scan_workers', 4)))
+            settings['download_retries'] = max(0, int(sonarrytdl.get('download_retries', 2)))
+            settings['rescan_debounce'] = float(sonarrytdl.get('rescan_debounce', 30))
+            settings['metrics_port'] = int(sonarrytdl.get('metrics_port', 0))
+            settings['metrics_dump'] = str(sonarrytdl.get('metrics_dump', 'False')).lower() == 'true'
+            settings['debug'] = sonarrytdl['debug'] in ['true', 'True']
         except Exception:
             sys.exit("Error with sonarrytdl config.yml values.")
 
         # Sonarr Setup
         try:
-            api = "api"
-            scheme = "http"
-            basedir = ""
-            if cfg['sonarr'].get('version', '').lower() == 'v4':
-                api = "api/v3"
-                logger.debug('Sonarr api set to v4')
-            if cfg['sonarr']['ssl'].lower() == 'true':
-                scheme = "https"
-            if cfg['sonarr'].get('basedir', ''):
-                basedir = '/' + cfg['sonarr'].get('basedir', '')
-
-            self.base_url = "{0}://{1}:{2}{3}".format(
-                scheme,
-                cfg['sonarr']['host'],
-                str(cfg['sonarr']['port']),
-                basedir
-            )
-            self.sonarr_api_version = api
-            self.api_key = cfg['sonarr']['apikey']
+            blocks = cfg['sonarr']
+            if isinstance(blocks, dict):
+                blocks = [dict(blocks, name=blocks.get('name', ''))]
+            instances = {}
+            for i, block in enumerate(blocks):
+                name = block.get('name', 'sonarr{}'.format(i + 1))
+                if name in instances:
+                    raise ValueError('Sonarr instance {} is configured twice'.format(name))
+                instances[name] = (self.sonarrsettings(block), block.get('series', cfg.get('series')))
         except Exception:
             sys.exit("Error with sonarr config.yml values.")
 
         # YTDL Setup
         try:
-            self.ytdl_format = cfg['ytdl']['default_format']
+            settings['ytdl_format'] = cfg['ytdl']['default_format']
+            settings['concurrent_fragments'] = int(cfg['ytdl'].get('concurrent_fragments', 1))
+            settings['http_chunk_size'] = parsebytes(cfg['ytdl'].get('http_chunk_size'))
         except Exception:
             sys.exit("Error with ytdl config.yml values.")
 
-        # YTDL Setup
+        # Series Setup
         try:
-            self.series = cfg["series"]
+            settings['instances'] = {
+                name: (sonarr_settings, ProfileIndex(series))
+                for name, (sonarr_settings, series) in instances.items()
+            }
         except Exception:
             sys.exit("Error with series config.yml values.")
+        return settings
 
-    def get_episodes_by_series_id(self, series_id):
-        """Returns all episodes for the given series"""
-        logger.debug('Begin call Sonarr for all episodes for series_id: {}'.format(series_id))
-        args = {'seriesId': series_id}
-        res = self.request_get("{}/{}/episode".format(
-            self.base_url, 
-            self.sonarr_api_version
-            ), args
-        )
-        return res.json()
-
-    def get_episode_files_by_series_id(self, series_id):
-        """Returns all episode files for the given series"""
-        res = self.request_get("{}/{}/episodefile?seriesId={}".format(
-            self.base_url, 
-            self.sonarr_api_version,
-            series_id
-        ))
-        return res.json()
-
-    def get_series(self):
-        """Return all series in your collection"""
-        logger.debug('Begin call Sonarr for all available series')
-        res = self.request_get("{}/{}/series".format(
-            self.base_url, 
-            self.sonarr_api_version
-        ))
-        return res.json()
-
-    def get_series_by_series_id(self, series_id):
-        """Return the series with the matching ID or 404 if no matching series is found"""
-        logger.debug('Begin call Sonarr for specific series series_id: {}'.format(series_id))
-        res = self.request_get("{}/{}/series/{}".format(
-            self.base_url,
-            self.sonarr_api_version,
-            series_id
-        ))
-        return res.json()
-
-    def request_get(self, url, params=None):
-        """Wrapper on the requests.get"""
-        logger.debug('Begin GET with url: {}'.format(url))
-        args = {
-            "apikey": self.api_key
-        }
-        if params is not None:
-            logger.debug('Begin GET with params: {}'.format(params))
-            args.update(params)
-        url = "{}?{}".format(
-            url,
-            urllib.parse.urlencode(args)
-        )
-        res = requests.get(url)
-        return res
-
-    def request_put(self, url, params=None, jsondata=None):
-        logger.debug('Begin PUT with url: {}'.format(url))
-        """Wrapper on the requests.put"""
-        headers = {
-            'Content-Type': 'application/json',
-        }
-        args = (
-            ('apikey', self.api_key),
-        )
-        if params is not None:
-            args.update(params)
-            logger.debug('Begin PUT with params: {}'.format(params))
-        res = requests.post(
-            url,
-            headers=headers,
-            params=args,
-            json=jsondata
+    def sonarrsettings(self, sonarr):
+        """``SonarrClient`` arguments of a sonarr config.yml block
+        - ``sonarr``: the sonarr block, or one instance of a sonarr list
+        returns:
+            ``tuple``: base url, api version, api key, timeout and retries
+        """
+        api = "api"
+        scheme = "http"
+        basedir = ""
+        if sonarr.get('version', '').lower() == 'v4':
+            api = "api/v3"
+            logger.debug('Sonarr api set to v4')
+        if sonarr['ssl'].lower() == 'true':
+            scheme = "https"
+        if sonarr.get('basedir', ''):
+            basedir = '/' + sonarr.get('basedir', '')
+
+        base_url = "{0}://{1}:{2}{3}".format(
+            scheme,
+            sonarr['host'],
+            str(sonarr['port']),
+            basedir
         )
-        return res
-
-    def rescanseries(self, series_id):
-        """Refresh series information from trakt and rescan disk"""
-        logger.debug('Begin call Sonarr to rescan for series_id: {}'.format(series_id))
-        data = {
-            "name": "RescanSeries",
-            "seriesId": str(series_id)
-        }
-        res = self.request_put(
-            "{}/{}/command".format(self.base_url, self.sonarr_api_version),
-            None,
-            data
+        return (
+            base_url,
+            api,
+            sonarr['apikey'],
+            sonarr.get('timeout', 30),
+            sonarr.get('retries', 3)
         )
-        return res.json()
 
-    def filterseries(self):
-        """Return all series in Sonarr that are to be downloaded by youtube-dl"""
-        series = self.get_series()
+    def filterseries(self, series=None, instance=None):
+        """Return all series in Sonarr that are to be downloaded by youtube-dl
+        - ``series``: Sonarr series of ``instance`` to filter, every series of every instance if None
+        - ``instance``: ``SonarrInstance`` the series come from
+        returns:
+            ``list``: Sonarr series with the matching config.yml ``profile`` and their ``instance``
+        """
+        if series is None:
+            def listseries(instance):
+                try:
+                    return self.filterseries(instance.client.get_series(), instance)
+                except requests.exceptions.RequestException as e:
+                    if len(self.instances) == 1:
+                        raise
+                    logger.error('Sonarr {} unavailable, its series are skipped - {}'.format(instance.name, e))
+                    return []
+
+            with metrics.timer('stage_seconds', stage='series'):
+                with ThreadPoolExecutor(max_workers=len(self.instances)) as pool:
+                    return [ser for matched in pool.map(listseries, self.instances.values()) for ser in matched]
         matched = []
-        for ser in series[:]:
-            for wnt in self.series:
-                if wnt['title'] == ser['title']:
-                    # Set default values
-                    ser['subtitles'] = False
-                    ser['playlistreverse'] = True
-                    ser['subtitles_languages'] = ['en']
-                    ser['subtitles_autogenerated'] = False
-                    # Update values
-                    if 'regex' in wnt:
-                        regex = wnt['regex']
-                        if 'sonarr' in regex:
-                            ser['sonarr_regex_match'] = regex['sonarr']['match']
-                            ser['sonarr_regex_replace'] = regex['sonarr']['replace']
-                        if 'site' in regex:
-                            ser['site_regex_match'] = regex['site']['match']
-                            ser['site_regex_replace'] = regex['site']['replace']
-                    if 'offset' in wnt:
-                        ser['offset'] = wnt['offset']
-                    if 'cookies_file' in wnt:
-                        ser['cookies_file'] = wnt['cookies_file']
-                    if 'format' in wnt:
-                        ser['format'] = wnt['format']
-                    if 'playlistreverse' in wnt:
-                        if wnt['playlistreverse'] == 'False':
-                            ser['playlistreverse'] = False
-                    if 'subtitles' in wnt:
-                        ser['subtitles'] = True
-                        if 'languages' in wnt['subtitles']:
-                            ser['subtitles_languages'] = wnt['subtitles']['languages']
-                        if 'autogenerated' in wnt['subtitles']:
-                            ser['subtitles_autogenerated'] = wnt['subtitles']['autogenerated']
-                    ser['url'] = wnt['url']
-                    matched.append(ser)
+        for ser in series:
+            for profile in instance.profiles.match(ser):
+                matched.append(ser.copy(profile=profile, instance=instance))
         for check in matched:
             if not check['monitored']:
-                logger.warn('{0} is not currently monitored'.format(ser['title']))
-        del series[:]
+                logger.warn('{0} is not currently monitored'.format(check['title']))
         return matched
 
-    def getseriesepisodes(self, series):
-        needed = []
-        for ser in series[:]:
-            episodes = self.get_episodes_by_series_id(ser['id'])
-            for eps in episodes[:]:
-                eps_date = now
-                if "airDateUtc" in eps:
-                    eps_date = datetime.strptime(eps['airDateUtc'], date_format)
-                    if 'offset' in ser:
-                        eps_date = offsethandler(eps_date, ser['offset'])
-                if not eps['monitored']:
-                    episodes.remove(eps)
-                elif eps['hasFile']:
-                    episodes.remove(eps)
-                elif eps_date > now:
-                    episodes.remove(eps)
-                else:
-                    if 'sonarr_regex_match' in ser:
-                        match = ser['sonarr_regex_match']
-                        replace = ser['sonarr_regex_replace']
-                        eps['title'] = re.sub(match, replace, eps['title'])
-                    needed.append(eps)
-                    continue
-            if len(episodes) == 0:
-                logger.info('{0} no episodes needed'.format(ser['title']))
-                series.remove(ser)
-            else:
-                logger.info('{0} missing {1} episodes'.format(
+    def wantedpages(self, instance, series):
+        """Missing episodes of the given series from an instance's wanted/missing list, a page at a time
+        - ``instance``: ``SonarrInstance`` to page through
+        - ``series``: series of the instance matched by ``filterseries``
+        yields:
+            ``list``: (series, its missing episodes on the page) pairs, a series
+            with episodes on several pages comes up once per page
+        """
+        matched = {}
+        for ser in series:
+            matched.setdefault(ser['id'], []).append(ser)
+        for records in instance.client.get_wanted_missing_pages():
+            grouped = {}
+            for eps in records:
+                if eps['seriesId'] in matched:
+                    grouped.setdefault(eps['seriesId'], []).append(eps)
+            # every profile of a series gets its own records, seriesepisodes rewrites their titles
+            yield [
+                (ser, [eps.copy() for eps in episodes])
+                for series_id, episodes in grouped.items()
+                for ser in matched[series_id]
+            ]
+
+    def seriesepisodes(self, ser, now, episodes=None):
+        """Wanted episodes of one series
+        - ``ser``: series matched by ``filterseries``
+        - ``now``: UTC time episodes must have aired by
+        - ``episodes``: episodes of the series from ``wantedpages``, fetched from Sonarr if None
+        returns:
+            ``list``: monitored, aired episodes without a file. None if the fetch failed
+        """
+        profile = ser['profile']
+        if episodes is None:
+            try:
+                with metrics.timer('stage_seconds', stage='episodes', series=ser['title']):
+                    episodes = list(ser['instance'].client.get_episodes_by_series_id(ser['id'], ser['revision']))
+            except requests.exceptions.RequestException as e:
+                logger.error('{0} episodes could not be fetched - {1}'.format(ser['title'], e))
+                return None
+        wanted = []
+        for eps in episodes:
+            eps_date = now
+            if "airDateUtc" in eps:
+                eps_date = datetime.strptime(eps['airDateUtc'], date_format)
+                if profile.offset is not None:
+                    eps_date = eps_date + profile.offset
+            if not eps['monitored'] or eps['hasFile'] or eps_date > now:
+                continue
+            eps['title'] = profile.episodetitle(eps['title'])
+            wanted.append(eps)
+        if len(wanted) == 0:
+            logger.info('{0} no episodes needed'.format(ser['title']))
+        else:
+            logger.info('{0} missing {1} episodes'.format(
+                ser['title'],
+                len(wanted)
+            ))
+            for i, e in enumerate(wanted):
+                logger.info('  {0}: {1} - {2}'.format(
+                    i + 1,
                     ser['title'],
-                    len(episodes)
+                    e['title']
                 ))
-                for i, e in enumerate(episodes):
-                    logger.info('  {0}: {1} - {2}'.format(
-                        i + 1,
-                        ser['title'],
-                        e['title']
-                    ))
-        return needed
+        return wanted
 
     def appendcookie(self, ytdlopts, cookies=None):
         """Checks if specified cookie file exists in config
@@ -301,13 +416,16 @@ class SonarrYTDL(object):
         else:
             return ytdlopts
 
-    def ytdl_eps_search_opts(self, regextitle, playlistreverse, cookies=None):
+    def ytdl_eps_search_opts(self, cookies=None):
+        """Youtube-dl options used to walk a series playlist
+        - ``cookies``: filename of cookie file to append to Youtube-dl opts
+        returns:
+            ytdlopts
+        """
         ytdlopts = {
             'ignoreerrors': True,
-            'playlistreverse': playlistreverse,
-            'matchtitle': regextitle,
+            'extract_flat': 'in_playlist',
             'quiet': True,
-
         }
         if self.debug is True:
             ytdlopts.update({
@@ -317,105 +435,498 @@ class SonarrYTDL(object):
             })
         ytdlopts = self.appendcookie(ytdlopts, cookies)
         if self.debug is True:
-            logger.debug('Youtube-DL opts used for episode matching')
+            logger.debug('Youtube-DL opts used for playlist extraction')
             logger.debug(ytdlopts)
         return ytdlopts
 
-    def ytsearch(self, ydl_opts, playlist):
-        try:
-            with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                result = ydl.extract_info(
-                    playlist,
-                    download=False
-                )
-        except Exception as e:
-            logger.error(e)
-        else:
-            video_url = None
-            if 'entries' in result and len(result['entries']) > 0:
+    def playlistentries(self, ydl, result):
+        """Walks a lazily extracted playlist, yielding video entries
+        - ``ydl``: YoutubeDL instance used to resolve nested playlists/tabs
+        - ``result``: info dict returned by ``extract_info(process=False)``
+        yields:
+            ``dict``: id, title, webpage_url and upload_date of each video
+        """
+        if result is None:
+            return
+        if 'entries' not in result:
+            yield {
+                'id': result.get('id'),
+                'title': result.get('title'),
+                'webpage_url': result.get('webpage_url') or result.get('url'),
+                'upload_date': result.get('upload_date'),
+            }
+            return
+        for entry in result['entries']:
+            if entry is None:
+                continue
+            if 'entries' in entry:
+                yield from self.playlistentries(ydl, entry)
+                continue
+            if entry.get('ie_key') == 'YoutubeTab' or not entry.get('title'):
+                # nested playlist (e.g. channel tabs) or a video we know nothing about yet
                 try:
-                    video_url = result['entries'][0].get('webpage_url')
+                    entry = ydl.extract_info(entry['url'], download=False, process=False)
                 except Exception as e:
                     logger.error(e)
-            else:
-                video_url = result.get('webpage_url')
-            if playlist == video_url:
-                return False, ''
-            if video_url is None:
-                logger.error('No video_url')
-                return False, ''
-            else:
-                return True, video_url
-
-    def download(self, series, episodes):
-        if len(series) != 0:
-            logger.info("Processing Wanted Downloads")
-            for s, ser in enumerate(series):
-                logger.info("  {}:".format(ser['title']))
-                for e, eps in enumerate(episodes):
-                    if ser['id'] == eps['seriesId']:
-                        cookies = None
-                        url = ser['url']
-                        if 'cookies_file' in ser:
-                            cookies = ser['cookies_file']
-                        ydleps = self.ytdl_eps_search_opts(upperescape(eps['title']), ser['playlistreverse'], cookies)
-                        found, dlurl = self.ytsearch(ydleps, url)
-                        if found:
-                            logger.info("    {}: Found - {}:".format(e + 1, eps['title']))
-                            ytdl_format_options = {
-                                'format': self.ytdl_format,
-                                'quiet': True,
-                                'merge-output-format': 'mp4',
-                                'outtmpl': '/sonarr_root{0}/Season {1}/{2} - S{1}E{3} - {4} WEBDL.%(ext)s'.format(
-                                    ser['path'],
-                                    eps['seasonNumber'],
-                                    ser['title'],
-                                    eps['episodeNumber'],
-                                    eps['title']
-                                ),
-                                'progress_hooks': [ytdl_hooks],
-                                'noplaylist': True,
-                            }
-                            ytdl_format_options = self.appendcookie(ytdl_format_options, cookies)
-                            if 'format' in ser:
-                                ytdl_format_options = self.customformat(ytdl_format_options, ser['format'])
-                            if 'subtitles' in ser:
-                                if ser['subtitles']:
-                                    postprocessors = []
-                                    postprocessors.append({
-                                        'key': 'FFmpegSubtitlesConvertor',
-                                        'format': 'srt',
-                                    })
-                                    postprocessors.append({
-                                        'key': 'FFmpegEmbedSubtitle',
-                                    })
-                                    ytdl_format_options.update({
-                                        'writesubtitles': True,
-                                        'allsubtitles': True,
-                                        'writeautomaticsub': True,
-                                        'subtitleslangs': ser['subtitles_languages'],
-                                        'postprocessors': postprocessors,
-                                    })
-
-
-                            if self.debug is True:
-                                ytdl_format_options.update({
-                                    'quiet': False,
-                                    'logger': YoutubeDLLogger(),
-                                    'progress_hooks': [ytdl_hooks_debug],
-                                })
-                                logger.debug('Youtube-DL opts used for downloading')
-                                logger.debug(ytdl_format_options)
-                            try:
-                                yt_dlp.YoutubeDL(ytdl_format_options).download([dlurl])
-                                self.rescanseries(ser['id'])
-                                logger.info("      Downloaded - {}".format(eps['title']))
-                            except Exception as e:
-                                logger.error("      Failed - {} - {}".format(eps['title'], e))
-                        else:
-                            logger.info("    {}: Missing - {}:".format(e + 1, eps['title']))
+                    continue
+                yield from self.playlistentries(ydl, entry)
+                continue
+            yield {
+                'id': entry.get('id'),
+                'title': entry.get('title'),
+                'webpage_url': entry.get('webpage_url') or entry.get('url'),
+                'upload_date': entry.get('upload_date'),
+            }
+
+    def ytplaylist(self, ydl_opts, playlist):
+        """Extracts a series playlist, without resolving every video
+        Only uploads newer than the cached ones are walked unless the
+        playlist cache has expired for the url. Urls that are not known to
+        list the newest upload first are walked in full every time.
+        - ``ydl_opts``: Youtube-dl options from ``ytdl_eps_search_opts``
+        - ``playlist``: url of the channel/playlist configured for the series
+        returns:
+            ``list``: playlist index of id, title, webpage_url and upload_date,
+            in the order the site lists them. None if extraction failed.
+        """
+        with self.playlistlock(playlist):
+            if self.playlistcache.checked(playlist) >= self.scanstarted:
+                # another series, possibly of another instance, already read this url during the scan
+                metrics.inc('cache_requests_total', cache='playlist', result='shared')
+                return self.playlistcache.index(playlist)
+            full = self.playlistcache.expired(playlist) or not newestfirst(playlist)
+            known = set() if full else self.playlistcache.known(playlist)
+            entries = []
+            try:
+                with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                    result = ydl.extract_info(
+                        playlist,
+                        download=False,
+                        process=False
+                    )
+                    if result is None:
+                        # ignoreerrors reports a failed extraction as None, an empty index would replace the cached one
+                        logger.error('Playlist {} could not be extracted'.format(playlist))
+                        return None
+                    for entry in self.playlistentries(ydl, result):
+                        if entry['id'] in known:
+                            break
+                        if entry['title']:
+                            entries.append(entry)
+            except Exception as e:
+                logger.error(e)
+                return None
+            index = self.playlistcache.update(playlist, entries, full)
+            metrics.inc('cache_requests_total', cache='playlist', result='miss' if full else 'hit')
+            logger.debug('Playlist index for {} holds {} videos ({})'.format(
+                playlist,
+                len(index),
+                'full refresh' if full else '{} new'.format(len(entries))
+            ))
+            return index
+
+    def playlistlock(self, playlist):
+        """Lock held while a series url is extracted, so it is read once at a time"""
+        with self.playlistlocks_lock:
+            return self.playlistlocks.setdefault(playlist, threading.Lock())
+
+    def startscan(self, urgent=False):
+        """Note a scan is starting, playlists read from here on are shared by its series
+        - ``urgent``: downloads the scan finds go ahead of those already queued, for webhook scans
+        """
+        self.scanstarted = time.time()
+        self.urgent = urgent
+
+    def matchepisodes(self, index, episodes, profile):
+        """Matches every wanted episode against the playlist index in one pass
+        - ``index``: playlist index from ``ytplaylist``
+        - ``episodes``: episodes wanted for the series
+        - ``profile``: series profile, for playlistreverse and the site regex
+        returns:
+            ``dict``: episode id mapped to the webpage_url of the best matching video
+        """
+        titles = {eps['id']: normalize(eps['title']) for eps in episodes}
+        entries = reversed(index) if profile.playlistreverse else index
+        candidates = rankmatches(
+            titles,
+            ((normalize(profile.sitetitle(entry['title'])), entry) for entry in entries)
+        )
+        found = {}
+        for eps_id, ranked in candidates.items():
+            found[eps_id] = ranked[0]['webpage_url']
+            if len(ranked) > 1:
+                logger.debug('{} videos match {}, using {} over {}'.format(
+                    len(ranked),
+                    titles[eps_id],
+                    ranked[0]['title'],
+                    ', '.join(entry['title'] for entry in ranked[1:])
+                ))
+        return found
+
+    def ytdl_download_opts(self, ser, eps):
+        """Youtube-dl options used to download an episode
+        - ``ser``: series matched by ``filterseries``
+        - ``eps``: episode to download
+        returns:
+            ytdlopts
+        """
+        ytdl_format_options = {
+            'format': self.ytdl_format,
+            'quiet': True,
+            'merge-output-format': 'mp4',
+            'outtmpl': '/sonarr_root{0}/Season {1}/{2} - S{1}E{3} - {4} WEBDL.%(ext)s'.format(
+                ser['path'],
+                eps['seasonNumber'],
+                ser['title'],
+                eps['episodeNumber'],
+                eps['title']
+            ),
+            'progress_hooks': [ytdl_hooks],
+            'noplaylist': True,
+        }
+        profile = ser['profile']
+        # fragments that fail are retried and then fail the download instead of being
+        # skipped, the .part file and fragment state are kept for the next attempt to continue
+        ytdl_format_options.update({
+            'concurrent_fragment_downloads': profile.concurrent_fragments or self.concurrent_fragments,
+            'continuedl': True,
+            'fragment_retries': 10,
+            'skip_unavailable_fragments': False,
+        })
+        http_chunk_size = profile.http_chunk_size or self.http_chunk_size
+        if http_chunk_size:
+            ytdl_format_options['http_chunk_size'] = http_chunk_size
+        ytdl_format_options = self.appendcookie(ytdl_format_options, profile.cookies_file)
+        ytdl_format_options = self.customformat(ytdl_format_options, profile.format)
+        if profile.subtitles:
+            postprocessors = []
+            postprocessors.append({
+                'key': 'FFmpegSubtitlesConvertor',
+                'format': 'srt',
+            })
+            postprocessors.append({
+                'key': 'FFmpegEmbedSubtitle',
+            })
+            ytdl_format_options.update({
+                'writesubtitles': True,
+                'allsubtitles': True,
+                'writeautomaticsub': True,
+                'subtitleslangs': profile.subtitles_languages,
+                'postprocessors': postprocessors,
+            })
+        if self.debug is True:
+            ytdl_format_options.update({
+                'quiet': False,
+                'logger': YoutubeDLLogger(),
+                'progress_hooks': [ytdl_hooks_debug],
+            })
+            logger.debug('Youtube-DL opts used for downloading')
+            logger.debug(ytdl_format_options)
+        return ytdl_format_options
+
+    def resolveepisode(self, job):
+        """Extract the matched video page once, ahead of the download stage
+        The download picks its format from this info dict instead of
+        extracting the page again, so download slots only transfer media.
+        Run by the download scheduler for the jobs next in line for a slot.
+        - ``job``: job from the ``JobStore``, gets ``info`` and ``resolved`` set
+        """
+        ytdl_format_options = dict(job['options'], quiet=True)
+        if self.debug is True:
+            ytdl_format_options.update({'quiet': False, 'logger': YoutubeDLLogger()})
+        try:
+            with metrics.timer('stage_seconds', stage='resolve', series=job['series_title']):
+                with yt_dlp.YoutubeDL(ytdl_format_options) as ydl:
+                    job['info'] = ydl.extract_info(job['url'], download=False, process=False)
+            job['resolved'] = time.monotonic()
+        except Exception as e:
+            logger.debug('Could not resolve {} ahead of downloading - {}'.format(job['url'], e))
+
+    def fetchepisode(self, ydl, job):
+        """Download a job, from its resolved info dict while that is fresh
+        Signed media urls expire, so stale info or a download refused with
+        403/410 falls back to extracting the page again.
+        """
+        info = job.get('info')
+        if info is None or time.monotonic() - job['resolved'] > RESOLVEDTTL:
+            ydl.download([job['url']])
+            return
+        try:
+            ydl.process_ie_result(info, download=True)
+            metrics.inc('resolved_downloads_total', result='reused')
+        except yt_dlp.utils.DownloadError as e:
+            if not re.search(r'HTTP Error (403|410)', str(e)):
+                raise
+            logger.debug('Resolved urls for {} expired, extracting again - {}'.format(job['url'], e))
+            metrics.inc('resolved_downloads_total', result='expired')
+            ydl.download([job['url']])
+
+    def downloadepisode(self, job):
+        """Download a queued job and have Sonarr pick it up
+        - ``job``: job from the ``JobStore``
+        """
+        postprocessed = {}
+
+        def postprocessing(d):
+            if d['status'] == 'started':
+                self.jobs.setstate(job['id'], 'postprocessing')
+                postprocessed[d['postprocessor']] = time.monotonic()
+            elif d['status'] == 'finished' and d['postprocessor'] in postprocessed:
+                metrics.observe(
+                    'stage_seconds',
+                    time.monotonic() - postprocessed.pop(d['postprocessor']),
+                    stage='postprocess',
+                    series=job['series_title']
+                )
+
+        ytdl_format_options = dict(job['options'])
+        ytdl_format_options.update({
+            'progress_hooks': [ytdl_hooks_debug if self.debug is True else ytdl_hooks],
+            'postprocessor_hooks': [postprocessing],
+        })
+        if self.debug is True:
+            ytdl_format_options['logger'] = YoutubeDLLogger()
+        deferred = {}
+        # a reload may replace or drop the pool while the download runs, the one held stays open
+        postprocess = self.holdpostprocess()
+        try:
+            self.jobs.setstate(job['id'], 'downloading')
+            try:
+                for attempt in range(self.download_retries + 1):
+                    resumed = partialbytes(ytdl_format_options['outtmpl'])
+                    if resumed:
+                        logger.info("      Resuming - {} from {:.1f}MiB already downloaded".format(job['title'], resumed / 1048576))
+                        metrics.inc('resumed_bytes_total', resumed)
+                    try:
+                        ydl = yt_dlp.YoutubeDL(ytdl_format_options)
+                        if postprocess is not None:
+                            defer(ydl, deferred)
+                        with metrics.timer('stage_seconds', stage='download', series=job['series_title']):
+                            with self.bandwidth.download(ydl) as hook:
+                                ydl.add_progress_hook(hook)
+                                self.fetchepisode(ydl, job)
+                        break
+                    except yt_dlp.utils.DownloadError as e:
+                        if attempt >= self.download_retries:
+                            raise
+                        logger.warning("      Retrying - {} ({}/{}) - {}".format(job['title'], attempt + 1, self.download_retries, e))
+                        metrics.inc('download_retries_total')
+                        job['info'] = None
+                        time.sleep(RETRYDELAY * (attempt + 1))
+            except Exception as e:
+                self.finishepisode(job, e)
+                return
+            if deferred:
+                self.jobs.setstate(job['id'], 'postprocessing')
+                postprocess.submit(
+                    job['options'],
+                    deferred,
+                    lambda error: self.finishepisode(job, error),
+                    job['series_title']
+                )
+                return
+            self.finishepisode(job)
+        finally:
+            if postprocess is not None:
+                postprocess.release()
+
+    def holdpostprocess(self):
+        """Current postprocessing pool, held so a reload cannot shut it down under a download
+        returns:
+            ``PostprocessPool``: to ``release`` once the download submitted to it, None if disabled
+        """
+        while True:
+            postprocess = self.postprocess
+            if postprocess is None or postprocess.hold():
+                return postprocess
+
+    def finishepisode(self, job, error=None):
+        """Record how a job ended and let the rescan queue know
+        Runs once the final file is in place, after any pooled postprocessing.
+        - ``job``: job from the ``JobStore``
+        - ``error``: exception that failed the download or its postprocessing
+        """
+        if error is None:
+            self.jobs.setstate(job['id'], 'done')
+            metrics.inc('downloads_total', result='done')
+            logger.info("      Downloaded - {}".format(job['title']))
         else:
-            logger.info("Nothing to process")
+            self.jobs.setstate(job['id'], 'failed', str(error))
+            metrics.inc('downloads_total', result='failed')
+            logger.error("      Failed - {} - {}".format(job['title'], error))
+        self.instances[job['instance']].rescans.done(job['series_id'], error is None)
+
+    def queuejobs(self, jobs, urgent=False):
+        """Hand jobs to the download pool
+        Every job is expected by the rescan queue before any is submitted, so
+        a quick download cannot trigger its series' rescan early.
+        - ``urgent``: the jobs jump the queue, see ``download_order``
+        """
+        for job in jobs:
+            self.instances[job['instance']].rescans.expect(job['series_id'])
+        for job in jobs:
+            aired = None
+            if job['aired']:
+                aired = calendar.timegm(datetime.strptime(job['aired'], date_format).timetuple())
+            self.downloads.submit(
+                job['url'],
+                self.downloadepisode,
+                job,
+                series=(job['instance'], job['series_id']),
+                priority=job['priority'],
+                aired=aired,
+                urgent=urgent
+            )
+
+    def resumejobs(self):
+        """Queue the jobs a previous run left unfinished, without searching again"""
+        self.jobs.prune()
+        jobs = []
+        for job in self.jobs.unfinished():
+            if job['instance'] in self.instances:
+                jobs.append(job)
+                continue
+            logger.warning('Sonarr instance {} is no longer configured, not resuming {}'.format(job['instance'], job['title']))
+            self.jobs.setstate(job['id'], 'failed', 'Sonarr instance no longer configured')
+        if jobs:
+            logger.info('Resuming {} unfinished downloads'.format(len(jobs)))
+        self.queuejobs(jobs)
+        return len(jobs)
+
+    def planepisode(self, ser, eps, url):
+        """Resolve the format a download of an episode would pick, without downloading
+        - ``ser``: series matched by ``filterseries``
+        - ``eps``: episode found on the site
+        - ``url``: matched video url
+        returns:
+            ``dict``: format asked for, format_id chosen and its estimated size
+            in bytes, None when the site does not tell
+        """
+        ytdl_format_options = self.ytdl_download_opts(ser, eps)
+        ytdl_format_options['skip_download'] = True
+        planned = {'format': ytdl_format_options['format'], 'format_id': None, 'filesize': None}
+        try:
+            with yt_dlp.YoutubeDL(ytdl_format_options) as ydl:
+                info = ydl.extract_info(url, download=False)
+        except Exception as e:
+            planned['error'] = str(e)
+            return planned
+        formats = info.get('requested_formats') or [info]
+        sizes = [fmt.get('filesize') or fmt.get('filesize_approx') for fmt in formats]
+        planned['format_id'] = info.get('format_id')
+        planned['filesize'] = int(sum(sizes)) if all(sizes) else None
+        return planned
+
+    def searchseries(self, ser, wanted, plan=None):
+        """Match the wanted episodes of a series on its site and queue the found ones
+        - ``ser``: series matched by ``filterseries``
+        - ``wanted``: episodes wanted for the series
+        - ``plan``: list to append what would happen to each episode to instead,
+          nothing is queued and the miss cache is left alone
+        """
+        logger.info("  {}:".format(ser['title']))
+        profile = ser['profile']
+        ydleps = self.ytdl_eps_search_opts(profile.cookies_file)
+        with metrics.timer('stage_seconds', stage='playlist', series=ser['title']):
+            index = self.ytplaylist(ydleps, profile.url)
+        if index is None:
+            if plan is not None:
+                plan.extend(self.planentry(ser, eps, 'error') for eps in wanted)
+            return
+        changed = self.playlistcache.changed(profile.url)
+        titles = {eps['id']: normalize(eps['title']) for eps in wanted}
+        skipped = [
+            eps['id'] for eps in wanted
+            if self.misscache.skip(ser['instance'].key(ser['id']), eps['id'], titles[eps['id']], changed)
+        ]
+        metrics.inc('cache_requests_total', len(skipped), cache='miss', result='hit')
+        metrics.inc('cache_requests_total', len(wanted) - len(skipped), cache='miss', result='miss')
+        with metrics.timer('stage_seconds', stage='match', series=ser['title']):
+            matches = self.matchepisodes(index, [eps for eps in wanted if eps['id'] not in skipped], profile)
+        if plan is not None:
+            found = [eps for eps in wanted if eps['id'] in matches]
+            with ThreadPoolExecutor(max_workers=self.scan_workers) as pool:
+                formats = dict(zip(
+                    [eps['id'] for eps in found],
+                    pool.map(lambda eps: self.planepisode(ser, eps, matches[eps['id']]), found)
+                ))
+            for eps in wanted:
+                if eps['id'] in skipped:
+                    plan.append(self.planentry(ser, eps, 'skipped'))
+                elif eps['id'] in matches:
+                    plan.append(self.planentry(ser, eps, 'found', matches[eps['id']], **formats[eps['id']]))
+                else:
+                    plan.append(self.planentry(ser, eps, 'missing'))
+            return
+        jobs = []
+        for e, eps in enumerate(wanted):
+            if eps['id'] in skipped:
+                logger.debug("    {}: Skipped, not found on earlier scans - {}:".format(e + 1, eps['title']))
+            elif eps['id'] in matches:
+                dlurl = matches[eps['id']]
+                logger.info("    {}: Found - {}:".format(e + 1, eps['title']))
+                self.misscache.forget(ser['instance'].key(ser['id']), eps['id'])
+                job = self.jobs.add(
+                    ser['instance'].name,
+                    ser['id'],
+                    ser['title'],
+                    eps['id'],
+                    eps['title'],
+                    dlurl,
+                    self.ytdl_download_opts(ser, eps),
+                    eps.get('airDateUtc'),
+                    profile.priority
+                )
+                if job is None:
+                    logger.info("      Already queued - {}".format(eps['title']))
+                    continue
+                jobs.append(job)
+            else:
+                logger.info("    {}: Missing - {}:".format(e + 1, eps['title']))
+                self.misscache.miss(ser['instance'].key(ser['id']), eps['id'], titles[eps['id']], changed)
+        self.queuejobs(jobs, self.urgent)
+
+    def planentry(self, ser, eps, status, url=None, **formats):
+        """One episode of a scan plan
+        - ``status``: found, missing, skipped (backing off after earlier misses)
+          or error (the site could not be read)
+        - ``url``: matched video url
+        - ``formats``: format details from ``planepisode``
+        """
+        entry = {
+            'instance': ser['instance'].name,
+            'series_id': ser['id'],
+            'series': ser['title'],
+            'episode_id': eps['id'],
+            'season': eps['seasonNumber'],
+            'episode': eps['episodeNumber'],
+            'title': eps['title'],
+            'status': status,
+            'url': url,
+        }
+        entry.update(formats)
+        return entry
+
+    def finishscan(self, wait=True):
+        """Persist caches, wait for the queued downloads and their rescans
+        - ``wait``: False returns straight away, leaving the downloads running.
+          Each series is rescanned once its downloads finish and the rescan
+          queue follows the command in the background.
+        """
+        self.playlistcache.save()
+        self.misscache.save()
+        self.sonarrcache.save()
+        if not wait:
+            return
+        self.downloads.wait()
+        for postprocess in self.retiredpools + [self.postprocess]:
+            if postprocess is not None:
+                postprocess.wait()
+        self.retiredpools = [postprocess for postprocess in self.retiredpools if not postprocess.closed]
+        for instance in self.instances.values():
+            instance.rescans.flush()
+        for instance in self.instances.values():
+            instance.rescans.wait()
 
     def set_scan_interval(self, interval):
         global SCANINTERVAL
@@ -426,19 +937,109 @@ class SonarrYTDL(object):
             logger.info('Default scan interval of every {} minutes in use'.format(interval))
         return
 
+    def set_webhook(self, port, apikey=None):
+        global WEBHOOKPORT, WEBHOOKAPIKEY
+        WEBHOOKPORT = int(port)
+        WEBHOOKAPIKEY = apikey
+        return
+
+
+client = None
+
 
-def main():
+def plan(path):
+    """Work out what a scan would download and write it as json, downloading nothing
+    Playlists are read through the playlist cache, which is saved so the next
+    scan profits. Jobs, the miss cache and Sonarr are left untouched.
+    - ``path``: file to write the plan to, - for stdout
+    """
     client = SonarrYTDL()
-    series = client.filterseries()
-    episodes = client.getseriesepisodes(series)
-    client.download(series, episodes)
+    entries = []
+    try:
+        series = client.filterseries()
+        asyncio.run(scan(client, series, client.scan_workers, entries))
+    except requests.exceptions.RequestException as e:
+        sys.exit('Sonarr unavailable, no plan made - {}'.format(e))
+    entries.sort(key=lambda entry: (entry['instance'], entry['series'], entry['season'], entry['episode']))
+    result = {
+        'generated': datetime.utcnow().strftime(date_format),
+        'episodes': entries,
+        'found': sum(1 for entry in entries if entry['status'] == 'found'),
+        'estimated_bytes': sum(entry.get('filesize') or 0 for entry in entries),
+    }
+    if path == '-':
+        json.dump(result, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+    else:
+        with open(path, 'w') as planfile:
+            json.dump(result, planfile, indent=2)
+        logger.info('Plan of {} episodes written to {}'.format(len(entries), path))
+
+
+def main(series_ids=None):
+    """Run a scan with the long-lived client, reloading config.yml if changed
+    - ``series_ids``: (instance name, Sonarr series id) pairs to scan, every configured series if None
+    """
+    global client
+    if client is None:
+        client = SonarrYTDL()
+        client.resumejobs()
+    else:
+        client.reload()
+    try:
+        if series_ids is None:
+            series = client.filterseries()
+        else:
+            series = []
+            for name, series_id in series_ids:
+                instance = client.instances.get(name)
+                if instance is None:
+                    logger.warning('Webhook for unknown Sonarr instance {} ignored'.format(name or '(unnamed)'))
+                    continue
+                instance.client.invalidate(series_id)
+                series.extend(client.filterseries([instance.client.get_series_by_series_id(series_id)], instance))
+        with metrics.timer('scan_seconds', kind='full' if series_ids is None else 'webhook'):
+            asyncio.run(scan(client, series, client.scan_workers, urgent=series_ids is not None, wait=False))
+    except requests.exceptions.RequestException as e:
+        logger.error('Sonarr unavailable, scan skipped - {}'.format(e))
+    if client.metrics_dump:
+        metrics.dump(CONFIGPATH + 'metrics.json')
     logger.info('Waiting...')
 
 
 if __name__ == "__main__":
+    if args.plan is not None:
+        plan(args.plan)
+        sys.exit()
     logger.info('Initial run')
     main()
-    schedule.every(int(SCANINTERVAL)).minutes.do(main)
+    interval = int(SCANINTERVAL)
+    schedule.every(interval).minutes.do(main)
+    if client.metrics_port:
+        metrics.serve(client.metrics_port)
+    webhooks = None
+    if WEBHOOKPORT:
+        webhooks = WebhookListener(WEBHOOKPORT, apikey=WEBHOOKAPIKEY)
+        webhooks.start()
+    # listeners keep the port they started on
+    ports = (WEBHOOKPORT, client.metrics_port)
     while True:
+        # compared rather than tied to reload(), a scan may have picked up the change first
+        client.reload()
+        if int(SCANINTERVAL) != interval:
+            interval = int(SCANINTERVAL)
+            schedule.clear()
+            schedule.every(interval).minutes.do(main)
+        if webhooks is not None and webhooks.apikey != WEBHOOKAPIKEY:
+            webhooks.apikey = WEBHOOKAPIKEY
+            logger.info('Webhook apikey changed by config.yml')
+        if (WEBHOOKPORT, client.metrics_port) != ports:
+            ports = (WEBHOOKPORT, client.metrics_port)
+            logger.warning('webhook_port and metrics_port changes take effect after a restart')
         schedule.run_pending()
+        if webhooks is not None:
+            series_ids = webhooks.pending()
+            if series_ids:
+                logger.info('Webhook scan for series_ids: {}'.format(series_ids))
+                main(series_ids)
         time.sleep(1)
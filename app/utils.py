@@ -1,44 +1,18 @@
 import re
 import os
+import glob
 import sys
 import datetime
 import yaml
 import logging
 from logging.handlers import RotatingFileHandler
+import metrics
 
 
 CONFIGFILE = os.environ['CONFIGPATH']
 # CONFIGPATH = CONFIGFILE.replace('config.yml', '')
 
 
-def upperescape(string):
-    """Uppercase and Escape string. Used to help with YT-DL regex match.
-    - ``string``: string to manipulate
-
-    returns:
-        ``string``: str new string
-    """
-    # UPPERCASE as YTDL is case insensitive for ease.
-    string = string.upper() 
-    # Remove quote characters as YTDL converts these.
-    string = string.replace('’',"'") 
-    string = string.replace('“','"')
-    string = string.replace('”','"')
-    # Escape the characters
-    string = re.escape(string)
-    # Make it look for and as whole or ampersands
-    string = string.replace('\\ AND\\ ','\\ (AND|&)\\ ')
-    # Make punctuation optional for human error
-    string = string.replace("'","([']?)") # optional apostrophe
-    string = string.replace(",","([,]?)") # optional comma
-    string = string.replace("!","([!]?)") # optional question mark
-    string = string.replace("\\.","([\\.]?)") # optional period
-    string = string.replace("\\?","([\\?]?)") # optional question mark
-    string = string.replace(":","([:]?)") # optional colon
-    string = re.sub("S\\\\", "([']?)"+"S\\\\", string) # optional belonging apostrophe (has to be last due to question mark)
-    return string
-
-
 def checkconfig():
     """Checks if config files exist in config path
     If no config available, will copy template to config folder and exit script
@@ -71,13 +45,12 @@ def checkconfig():
         return cfg
 
 
-def offsethandler(airdate, offset):
-    """Adjusts an episodes airdate
-    - ``airdate``: Airdate from sonarr # (datetime)
+def offsetdelta(offset):
+    """Converts an offset from config.yml to a timedelta
     - ``offset``: Offset from series config.yml # (dict)
 
     returns:
-        ``airdate``: datetime updated original airdate
+        ``timedelta``: offset to add to an airdate
     """
     weeks = 0
     days = 0
@@ -91,8 +64,34 @@ def offsethandler(airdate, offset):
         hours = int(offset['hours'])
     if 'minutes' in offset:
         minutes = int(offset['minutes'])
-    airdate = airdate + datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes)
-    return airdate
+    return datetime.timedelta(weeks=weeks, days=days, hours=hours, minutes=minutes)
+
+
+def parsebytes(value):
+    """Converts a size from config.yml to bytes
+    - ``value``: bytes with an optional K, M or G suffix (e.g. 500K, 2.5M)
+
+    returns:
+        ``int``: bytes, None when empty or 0
+    """
+    if value is None:
+        return None
+    match = re.match(r'^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?\s*$', str(value).upper())
+    if match is None:
+        raise ValueError('Invalid size {}'.format(value))
+    size = int(float(match.group(1)) * 1024 ** ' KMG'.index(match.group(2) or ' '))
+    return size or None
+
+
+def partialbytes(outtmpl):
+    """Bytes already on disk in ``.part`` files of a download
+    - ``outtmpl``: output template of the download, ending in ``%(ext)s``
+
+    returns:
+        ``int``: total size of the partial files a retry will continue from
+    """
+    prefix = glob.escape(outtmpl.replace('%(ext)s', ''))
+    return sum(os.path.getsize(path) for path in glob.glob(prefix + '*.part'))
 
 
 class YoutubeDLLogger(object):
@@ -113,8 +112,15 @@ class YoutubeDLLogger(object):
         self.logger.error(msg)
 
 
+def ytdl_hooks_metrics(d):
+    if d['status'] == 'finished':
+        metrics.inc('download_bytes_total', d.get('total_bytes') or d.get('downloaded_bytes') or 0)
+        metrics.inc('download_transfer_seconds_total', d.get('elapsed') or 0)
+
+
 def ytdl_hooks_debug(d):
     logger = logging.getLogger('sonarr_youtubedl')
+    ytdl_hooks_metrics(d)
     if d['status'] == 'finished':
         file_tuple = os.path.split(os.path.abspath(d['filename']))
         logger.info("      Done downloading {}".format(file_tuple[1]))  # print("Done downloading {}".format(file_tuple[1]))
@@ -125,6 +131,7 @@ def ytdl_hooks_debug(d):
 
 def ytdl_hooks(d):
     logger = logging.getLogger('sonarr_youtubedl')
+    ytdl_hooks_metrics(d)
     if d['status'] == 'finished':
         file_tuple = os.path.split(os.path.abspath(d['filename']))
         logger.info("      Downloaded - {}".format(file_tuple[1]))
@@ -0,0 +1,91 @@
+import json
+import queue
+import logging
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+logger = logging.getLogger('sonarr_youtubedl')
+
+# Sonarr connect events that carry nothing worth scanning for
+IGNORED_EVENTS = ['Test', 'Health', 'HealthRestored', 'ApplicationUpdate', 'SeriesDelete', 'ManualInteractionRequired']
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    """Accepts Sonarr webhook/connect events and queues their series id
+
+    The url path names the Sonarr instance the event came from, ``/`` for a
+    single unnamed instance and e.g. ``/anime`` for the instance named anime.
+    """
+
+    def do_POST(self):
+        listener = self.server.listener
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        instance = urllib.parse.unquote(url.path.strip('/'))
+        if listener.apikey and query.get('apikey', [''])[0] != listener.apikey:
+            self.send_error(401)
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            event = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            self.send_error(400)
+            return
+        event_type = event.get('eventType', '')
+        series_id = (event.get('series') or {}).get('id')
+        if event_type not in IGNORED_EVENTS and series_id is not None:
+            logger.info('Webhook {} received for series_id: {}{}'.format(
+                event_type,
+                series_id,
+                ' of {}'.format(instance) if instance else ''
+            ))
+            listener.queue.put((instance, series_id))
+        else:
+            logger.debug('Webhook {} ignored'.format(event_type))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        logger.debug('Webhook ' + format % args)
+
+
+class WebhookListener(object):
+    """Small local HTTP listener for Sonarr webhooks
+
+    Runs in a daemon thread, the scheduler loop collects the series ids
+    with ``pending`` and scans only those series.
+    """
+
+    def __init__(self, port, host='0.0.0.0', apikey=None):
+        """Set up the listener
+        - ``port``: port to listen on
+        - ``host``: address to bind
+        - ``apikey``: if set, required as the ``apikey`` query parameter of the webhook url
+        """
+        self.queue = queue.Queue()
+        self.apikey = apikey
+        self.server = ThreadingHTTPServer((host, int(port)), WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.listener = self
+        self.thread = threading.Thread(target=self.server.serve_forever, name='webhook', daemon=True)
+
+    def start(self):
+        self.thread.start()
+        logger.info('Listening for Sonarr webhooks on port {}'.format(self.server.server_address[1]))
+
+    def pending(self):
+        """(instance name, series id) pairs received since the last call, without duplicates"""
+        series_ids = []
+        while True:
+            try:
+                series_id = self.queue.get_nowait()
+            except queue.Empty:
+                return series_ids
+            if series_id not in series_ids:
+                series_ids.append(series_id)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
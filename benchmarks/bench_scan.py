@@ -0,0 +1,369 @@
+"""Scan benchmark against a stand-in Sonarr and a stub yt-dlp extractor
+
+Runs the scan the daemon runs (filterseries and the pipeline scan, then
+finishscan waiting for the downloads) against synthetic Sonarr libraries
+served over HTTP, with a stub yt-dlp serving synthetic playlists and
+skipping the actual downloads.
+Every library size runs in its own process so peak RSS is comparable.
+
+Reports per size: cold and warm scan wall time, Sonarr request counts,
+peak RSS and matches per second, compared against baselines.json. Each
+size runs --runs times, the best wall time and peak RSS are kept.
+
+    python benchmarks/bench_scan.py                   # 10, 1k and 10k series
+    python benchmarks/bench_scan.py --sizes 10 1000   # selected library sizes
+    python benchmarks/bench_scan.py --save-baseline   # store results as the new baselines
+
+Exits non zero when a scan sends more Sonarr requests to an endpoint than
+its baseline, when peak RSS grows by more than --rss-tolerance, or when a
+scan is slower than its baseline by more than --tolerance and at least
+--time-floor seconds. Scan stages and downloads run on threads that
+compete for the interpreter, so wall time varies by a second or two
+between runs of the same code and cannot be gated on alone.
+"""
+import os
+import re
+import sys
+import json
+import time
+import asyncio
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import yaml
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+APP = os.path.join(ROOT, 'app')
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+VIDEO_HOST = 'https://videos.invalid/series/'
+
+
+def episodetitle(series_id, number):
+    return 'Episode {} of Series {}'.format(number, series_id)
+
+
+class Library(object):
+    """Synthetic Sonarr library
+
+    Every series has ``episodes`` aired, monitored episodes, the odd ones
+    are missing their file. The playlist of a series holds ``videos``
+    videos, the first ``found`` of the missing episodes among them.
+    """
+
+    def __init__(self, size, episodes, videos, found):
+        self.size = size
+        self.episodes = episodes
+        self.videos = videos
+        self.found = found
+        self.series = [{
+            'id': series_id,
+            'title': 'Series {}'.format(series_id),
+            'path': '/tv/Series {}'.format(series_id),
+            'tvdbId': 100000 + series_id,
+            'monitored': True,
+            'seasons': [{'seasonNumber': 1, 'monitored': True}],
+            'images': [{'coverType': 'poster', 'url': '/MediaCover/{}/poster.jpg'.format(series_id)}],
+            'statistics': {'episodeCount': episodes, 'episodeFileCount': episodes // 2},
+        } for series_id in range(1, size + 1)]
+
+    def seriesepisodes(self, series_id):
+        return [{
+            'id': series_id * 10000 + number,
+            'seriesId': series_id,
+            'seasonNumber': 1,
+            'episodeNumber': number,
+            'title': episodetitle(series_id, number),
+            'airDateUtc': '2020-01-01T00:00:00Z',
+            'monitored': True,
+            'hasFile': number % 2 == 0,
+        } for number in range(1, self.episodes + 1)]
+
+    def missing(self):
+        for ser in self.series:
+            for eps in self.seriesepisodes(ser['id']):
+                if not eps['hasFile']:
+                    yield eps
+
+    def playlist(self, series_id):
+        missing = [eps for eps in self.seriesepisodes(series_id) if not eps['hasFile']][:self.found]
+        for number in range(self.videos, 0, -1):
+            title = 'Filler upload {} of Series {}'.format(number, series_id)
+            if number <= len(missing):
+                title = missing[number - 1]['title']
+            yield {
+                '_type': 'url',
+                'id': '{}-{}'.format(series_id, number),
+                'title': title,
+                'url': 'https://videos.invalid/watch/{}-{}'.format(series_id, number),
+            }
+
+
+class FakeSonarrHandler(BaseHTTPRequestHandler):
+
+    def reply(self, data):
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def count(self):
+        path = re.sub(r'/\d+(?=/|$)', '/:id', urllib.parse.urlparse(self.path).path)
+        key = '{} {}'.format(self.command, path)
+        with self.server.lock:
+            self.server.requests[key] = self.server.requests.get(key, 0) + 1
+
+    def do_GET(self):
+        self.count()
+        library = self.server.library
+        url = urllib.parse.urlparse(self.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        path = url.path.split('/')[3:]
+        if path == ['series']:
+            self.reply(library.series)
+        elif path[0] == 'series':
+            self.reply(library.series[int(path[1]) - 1])
+        elif path == ['episode']:
+            self.reply(library.seriesepisodes(int(query['seriesId'])))
+        elif path == ['wanted', 'missing']:
+            page, page_size = int(query['page']), int(query['pageSize'])
+            missing = list(library.missing())
+            self.reply({
+                'page': page,
+                'pageSize': page_size,
+                'totalRecords': len(missing),
+                'records': missing[(page - 1) * page_size:page * page_size],
+            })
+        elif path[0] == 'command':
+            self.reply({'id': int(path[1]), 'status': 'completed'})
+        else:
+            self.send_error(404)
+
+    def do_POST(self):
+        self.count()
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with self.server.lock:
+            self.server.commands += 1
+            self.reply({'id': self.server.commands, 'status': 'queued'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeYoutubeDL(object):
+    """Stand-in for yt_dlp.YoutubeDL serving the library's playlists"""
+
+    library = None
+    downloads = 0
+    lock = threading.Lock()
+
+    def __init__(self, params=None):
+        self.params = params or {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def add_progress_hook(self, hook):
+        pass
+
+    def dl(self, name, info, subtitle=False, test=False):
+        return True, True
+
+    def extract_info(self, url, download=False, process=True):
+        if not url.startswith(VIDEO_HOST):
+            return {'_type': 'video', 'id': url, 'webpage_url': url, 'formats': []}
+        series_id = int(url[len(VIDEO_HOST):])
+        return {'_type': 'playlist', 'id': url, 'entries': self.library.playlist(series_id)}
+
+    def process_ie_result(self, info, download=True):
+        return self.download([info['webpage_url']])
+
+    def download(self, urls):
+        with FakeYoutubeDL.lock:
+            FakeYoutubeDL.downloads += len(urls)
+        return 0
+
+
+def writeconfig(configdir, library, port, configured, episode_fetch):
+    cfg = {
+        'sonarrytdl': {
+            'scan_interval': 60,
+            'debug': False,
+            'rescan_debounce': 0,
+            'episode_fetch': episode_fetch,
+        },
+        'sonarr': {
+            'host': '127.0.0.1',
+            'port': port,
+            'apikey': 'benchmark',
+            'ssl': 'false',
+            'version': 'v4',
+        },
+        'ytdl': {
+            'default_format': 'best',
+        },
+        'series': [{
+            'title': ser['title'],
+            'url': VIDEO_HOST + str(ser['id']),
+        } for ser in library.series[:configured]],
+    }
+    path = os.path.join(configdir, 'config.yml')
+    with open(path, 'w') as configfile:
+        yaml.safe_dump(cfg, configfile)
+    return path
+
+
+def runone(args):
+    """Benchmark one library size in this process, printing the result as json"""
+    library = Library(args.run_one, args.episodes, args.videos, args.found)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeSonarrHandler)
+    server.daemon_threads = True
+    server.library = library
+    server.lock = threading.Lock()
+    server.requests = {}
+    server.commands = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    configdir = tempfile.mkdtemp(prefix='sonarr_youtubedl_bench_')
+    configured = min(args.configured, args.run_one)
+    os.environ['CONFIGPATH'] = writeconfig(configdir, library, server.server_address[1], configured, args.episode_fetch)
+    os.makedirs(os.path.join(ROOT, 'logs'), exist_ok=True)
+    sys.argv = [sys.argv[0]]
+    sys.path.insert(0, APP)
+    import sonarr_youtubedl
+    for handler in sonarr_youtubedl.logger.handlers[:]:
+        sonarr_youtubedl.logger.removeHandler(handler)
+    FakeYoutubeDL.library = library
+    sonarr_youtubedl.yt_dlp.YoutubeDL = FakeYoutubeDL
+
+    client = sonarr_youtubedl.SonarrYTDL()
+    result = {'series': args.run_one, 'configured': configured}
+    for scan in ['cold', 'warm']:
+        FakeYoutubeDL.downloads = 0
+        server.requests = {}
+        start = time.monotonic()
+        series = client.filterseries()
+        asyncio.run(sonarr_youtubedl.scan(client, series, client.scan_workers, wait=False))
+        client.finishscan()
+        seconds = time.monotonic() - start
+        result[scan] = {
+            'seconds': round(seconds, 3),
+            'matches': FakeYoutubeDL.downloads,
+            'matches_per_second': round(FakeYoutubeDL.downloads / seconds, 1),
+            'requests': dict(sorted(server.requests.items())),
+        }
+    result['peak_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    client.downloads.shutdown()
+    server.shutdown()
+    print(json.dumps(result))
+
+
+def best(results):
+    """Combine runs of one size, keeping the fastest scans and the lowest peak RSS"""
+    result = dict(results[0])
+    result['peak_rss_mb'] = min(run['peak_rss_mb'] for run in results)
+    for scan in ['cold', 'warm']:
+        result[scan] = min((run[scan] for run in results), key=lambda current: current['seconds'])
+    return result
+
+
+def report(result, baseline, tolerance, time_floor, rss_tolerance):
+    """Print a result next to its baseline, returns False on a regression"""
+    ok = True
+    line = '{} series ({} configured), peak RSS {} MB'.format(
+        result['series'],
+        result['configured'],
+        result['peak_rss_mb']
+    )
+    if baseline is not None:
+        line += ' (baseline {} MB)'.format(baseline['peak_rss_mb'])
+        if result['peak_rss_mb'] > baseline['peak_rss_mb'] * (1 + rss_tolerance):
+            line += ' REGRESSION'
+            ok = False
+    print(line)
+    for scan in ['cold', 'warm']:
+        current = result[scan]
+        line = '  {}: {}s, {} matches, {} matches/s, {} Sonarr requests'.format(
+            scan,
+            current['seconds'],
+            current['matches'],
+            current['matches_per_second'],
+            sum(current['requests'].values())
+        )
+        if baseline is not None:
+            limit = max(baseline[scan]['seconds'] * (1 + tolerance), baseline[scan]['seconds'] + time_floor)
+            line += ' (baseline {}s)'.format(baseline[scan]['seconds'])
+            if current['seconds'] > limit:
+                line += ' REGRESSION'
+                ok = False
+            for endpoint, count in sorted(current['requests'].items()):
+                expected = baseline[scan]['requests'].get(endpoint, 0)
+                if count > expected:
+                    line += '\n    {} {} requests (baseline {}) REGRESSION'.format(endpoint, count, expected)
+                    ok = False
+        print(line)
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark sonarr_youtubedl scans.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 1000, 10000], help='Sonarr library sizes to run')
+    parser.add_argument('--configured', type=int, default=200, help='series configured in config.yml')
+    parser.add_argument('--episodes', type=int, default=20, help='episodes per series, half are missing')
+    parser.add_argument('--videos', type=int, default=500, help='videos in each series playlist')
+    parser.add_argument('--found', type=int, default=5, help='missing episodes per series present in its playlist')
+    parser.add_argument('--episode-fetch', default='series', choices=['series', 'missing'], help='sonarrytdl episode_fetch')
+    parser.add_argument('--runs', type=int, default=3, help='runs per library size, the best is kept')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='allowed slowdown over the baseline')
+    parser.add_argument('--time-floor', type=float, default=2.0, help='seconds of slowdown always allowed')
+    parser.add_argument('--rss-tolerance', type=float, default=0.15, help='allowed peak RSS growth over the baseline')
+    parser.add_argument('--save-baseline', action='store_true', help='store the results in baselines.json')
+    parser.add_argument('--run-one', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_one is not None:
+        runone(args)
+        return
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as baselinefile:
+            baselines = json.load(baselinefile)
+    ok = True
+    for size in args.sizes:
+        command = [
+            sys.executable, os.path.abspath(__file__),
+            '--run-one', str(size),
+            '--configured', str(args.configured),
+            '--episodes', str(args.episodes),
+            '--videos', str(args.videos),
+            '--found', str(args.found),
+            '--episode-fetch', args.episode_fetch,
+        ]
+        results = []
+        for _ in range(max(1, args.runs)):
+            output = subprocess.run(command, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+            results.append(json.loads(output.strip().splitlines()[-1]))
+        result = best(results)
+        key = '{}-{}'.format(size, args.episode_fetch)
+        baseline = None if args.save_baseline else baselines.get(key)
+        ok = report(result, baseline, args.tolerance, args.time_floor, args.rss_tolerance) and ok
+        baselines[key] = result
+    if args.save_baseline:
+        with open(BASELINES, 'w') as baselinefile:
+            json.dump(baselines, baselinefile, indent=2, sort_keys=True)
+            baselinefile.write('\n')
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()